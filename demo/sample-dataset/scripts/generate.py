@@ -1,24 +1,39 @@
 import os
+import re
+import gzip
 import shutil
+import time
+import hashlib
 import zipfile
 import requests
 import json
-from typing import Dict, TypedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, TypedDict
 
 DIR = "./generated"
 SOURCE_ZIP_NAME = "raw_cases[cases_39155]"
 SOURCE_DIR = os.path.join(DIR, "source")
 SOURCE_CASE_ZIP = os.path.join(SOURCE_DIR, f"{SOURCE_ZIP_NAME}.zip")
 PROCESSED_DIR = os.path.join(DIR, "processed")
-PROCESSED_CASES = os.path.join(PROCESSED_DIR, "cases")
 PROCESSED_MAP_TXT = os.path.join(PROCESSED_DIR, "Map.txt")
 ASSETS_DIR = os.path.join(DIR, "assets")
+SHARDS_DIR = os.path.join(DIR, "shards")
 GET_TIMEOUT = 10800 # three hour timeout
-
-print("----------------------------------------------")
-print("Building corpus dataset - SigmaLaw - Large Legal Text Corpus and Word Embeddings")
-
-print("----------------------------------------------")
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_BACKOFF = 5 # seconds before the first retry, doubled on every further retry
+PROGRESS_INTERVAL = 10 # seconds between download progress reports
+SOURCE_CASE_ZIP_URL = "https://osf.io/download/w3paz/"
+# optional expected sha256 of the source zip, verified after download when set
+SOURCE_CASE_ZIP_SHA256 = os.environ.get("SOURCE_CASE_ZIP_SHA256")
+MAP_TXT_URL = "https://osf.io/download/khpwd/"
+# number of processes zipping categories in parallel, defaults to all cores
+ZIP_WORKERS = int(os.environ["ZIP_WORKERS"]) if os.environ.get("ZIP_WORKERS") else None
+# optional pre-chunked JSONL shards of the corpus for bulk embedding
+SHARDS = os.environ.get("SHARDS", "false").lower() == "true"
+SHARD_CHUNK_TOKENS = int(os.environ.get("SHARD_CHUNK_TOKENS", 256)) # whitespace separated tokens per chunk
+SHARD_SIZE = int(os.environ.get("SHARD_SIZE", 10000)) # chunks per shard
+SHARD_COMPRESS = os.environ.get("SHARD_COMPRESS", "false").lower() == "true" # gzip shards
 
 class DatasetMetadata(TypedDict):
     Domain: str
@@ -57,68 +72,331 @@ def parseCategories(map_txt_path: str) -> TCategoryMap:
             mapping[category_id] = category_name
     return mapping
 
-if not os.path.isdir(ASSETS_DIR):
+def sha256File(path: str, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest
+
+def contentRangeTotal(content_range: Optional[str]) -> Optional[int]:
+    """Complete length from a Content-Range header, e.g. `bytes */1234` sent with a 416"""
+    match = re.search(r"/(\d+)\s*$", content_range or "")
+    return int(match.group(1)) if match else None
+
+def download(url: str, path: str, sha256: Optional[str] = None, retries: int = DOWNLOAD_RETRIES) -> str:
+    """Stream url to path in chunks, resuming partial downloads with HTTP Range requests.
+
+    Data is written to `<path>.part` and only moved to path once complete and, if `sha256`
+    is given, verified. Returns the sha256 hex digest of the downloaded file.
+    """
+    part_path = f"{path}.part"
+    print(f"[Start] Downloading {path} ...")
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, allow_redirects=True, timeout=GET_TIMEOUT) as response:
+                if offset and response.status_code == 416:
+                    # the partial file is only complete if it is exactly the size of the content
+                    total = contentRangeTotal(response.headers.get("Content-Range"))
+                    if total == offset:
+                        break
+                    print(f"Partial download of {offset} bytes does not match the content size ({total}), restarting download")
+                    os.remove(part_path)
+                    continue
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    print("Server does not support resuming, restarting download")
+                    offset = 0
+                if offset:
+                    print(f"Resuming download from {offset} bytes")
+                received = 0
+                start = last_report = time.monotonic()
+                with open(part_path, "ab" if offset else "wb") as file:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+                        received += len(chunk)
+                        now = time.monotonic()
+                        if now - last_report >= PROGRESS_INTERVAL:
+                            last_report = now
+                            print(f"  {(offset + received) / 1e6:.1f}MB downloaded ({received / 1e6 / (now - start):.2f}MB/s)", flush=True)
+                elapsed = max(time.monotonic() - start, 1e-9)
+                print(f"Received {received / 1e6:.1f}MB in {elapsed:.1f}s ({received / 1e6 / elapsed:.2f}MB/s)")
+        except requests.RequestException as error:
+            attempt += 1
+            if attempt >= retries:
+                raise
+            backoff = DOWNLOAD_RETRY_BACKOFF * 2 ** (attempt - 1)
+            print(f"Download interrupted ({error}), retrying {attempt}/{retries - 1} in {backoff}s ...")
+            time.sleep(backoff)
+            continue
+        break
+
+    digest = sha256File(part_path).hexdigest()
+    if sha256 is not None and digest != sha256.lower():
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch for {path}: expected {sha256}, got {digest}")
+    os.replace(part_path, path)
+    print(f"[Complete] Downloaded {path} (sha256 {digest})")
+    return digest
+
+def tmpPath(path: str) -> str:
+    """Hidden temp file next to path, dotfiles are ignored by the dataset stack so an interrupted run leaves no invalid assets"""
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+
+def writeAtomic(path: str, data: str) -> None:
+    tmp_path = tmpPath(path)
+    with open(tmp_path, "w") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+def categoryMetadata(categoryId: str, categories: TCategoryMap) -> AssetMetadata:
+    return AssetMetadata(
+        **DEFAULT_METADATA,
+        CategoryId=categoryId,
+        Category=categories[categoryId],
+        OriginalLocation=f"https://osf.io/8mjcy#preprocessed_cases[cases_29404]/{categoryId}",
+        AssetKeyPrefix=f"/cases/{categoryId}/"
+    )
+
+def groupCategoryEntries(zip_ref: zipfile.ZipFile, root: str = SOURCE_ZIP_NAME) -> Dict[str, List[zipfile.ZipInfo]]:
+    """Group the file entries of the source zip by category, from their `<root>/<categoryId>/` prefix"""
+    entries: Dict[str, List[zipfile.ZipInfo]] = {}
+    for info in zip_ref.infolist():
+        parts = info.filename.split("/")
+        if info.is_dir() or len(parts) < 3 or parts[0] != root:
+            continue
+        entries.setdefault(parts[1], []).append(info)
+    return entries
+
+def categoryHash(infos: List[zipfile.ZipInfo], metadata: AssetMetadata) -> str:
+    """Hash of the metadata and the names, sizes and CRCs of a category's entries, without reading their data"""
+    digest = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode())
+    for info in sorted(infos, key=lambda info: info.filename):
+        digest.update(f"{info.filename}:{info.file_size}:{info.CRC}".encode())
+    return digest.hexdigest()
+
+def zipCategory(source_zip: str, names: List[str], prefix: str, assets_dir: str, metadata: AssetMetadata) -> dict:
+    """Stream the entries of a category from the source zip into `category-<id>.zip`, nothing is extracted to disk"""
+    start = time.monotonic()
+    zip_file = os.path.join(assets_dir, f"category-{metadata['CategoryId']}.zip")
+    tmp_zip_file = tmpPath(zip_file)
+    with zipfile.ZipFile(source_zip, "r") as source_ref, zipfile.ZipFile(tmp_zip_file, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for name in names:
+            info = source_ref.getinfo(name)
+            arc_info = zipfile.ZipInfo(name[len(prefix):], date_time=info.date_time)
+            arc_info.compress_type = zipfile.ZIP_DEFLATED
+            arc_info.external_attr = info.external_attr
+            with source_ref.open(info) as src, zip_ref.open(arc_info, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+                shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+    os.replace(tmp_zip_file, zip_file)
+    writeAtomic(f"{zip_file}.metadata", json.dumps(metadata, indent=2))
+    return {"Size": os.path.getsize(zip_file), "Seconds": time.monotonic() - start}
+
+def assetsManifestPath(assets_dir: str) -> str:
+    """Manifest of the category hashes, kept beside rather than in assets_dir which may only hold the zip assets"""
+    return f"{os.path.normpath(assets_dir)}-manifest.json"
+
+def assetsBuilt(assets_dir: str) -> bool:
+    """Whether the manifest and every category zip and metadata it lists are present"""
+    manifest_file = assetsManifestPath(assets_dir)
+    if not os.path.isfile(manifest_file):
+        return False
+    with open(manifest_file) as f:
+        manifest: Dict[str, str] = json.load(f)
+    return bool(manifest) and all(
+        os.path.isfile(os.path.join(assets_dir, f"category-{categoryId}.zip"))
+        and os.path.isfile(os.path.join(assets_dir, f"category-{categoryId}.zip.metadata"))
+        for categoryId in manifest
+    )
+
+def zipCategories(source_zip: str, assets_dir: str, categories: TCategoryMap, workers: Optional[int] = ZIP_WORKERS) -> Dict[str, dict]:
+    """Repackage every category of source_zip into its own zip in a process pool, returns the results by category id.
+
+    Per category content hashes are kept in `<assets_dir>-manifest.json` so that unchanged
+    categories are skipped on the next run.
+    """
+    manifest_file = assetsManifestPath(assets_dir)
+    manifest: Dict[str, str] = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    with zipfile.ZipFile(source_zip, "r") as zip_ref:
+        entries = groupCategoryEntries(zip_ref)
+
+    results: Dict[str, dict] = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for categoryId in sorted(entries):
+            metadata = categoryMetadata(categoryId, categories)
+            content_hash = categoryHash(entries[categoryId], metadata)
+            zip_file = os.path.join(assets_dir, f"category-{categoryId}.zip")
+            results[categoryId] = {"CategoryId": categoryId, "Hash": content_hash, "Skipped": True}
+            if manifest.get(categoryId) == content_hash and os.path.isfile(zip_file) and os.path.isfile(f"{zip_file}.metadata"):
+                results[categoryId].update(Size=os.path.getsize(zip_file), Seconds=0.0)
+                print(f"  category-{categoryId}.zip: {results[categoryId]['Size'] / 1e6:.1f}MB unchanged", flush=True)
+                continue
+            futures[categoryId] = executor.submit(
+                zipCategory,
+                source_zip,
+                [info.filename for info in entries[categoryId]],
+                f"{SOURCE_ZIP_NAME}/{categoryId}/",
+                assets_dir,
+                metadata,
+            )
+
+        for categoryId, future in futures.items():
+            result = results[categoryId]
+            result.update(future.result(), Skipped=False)
+            print(f"  category-{categoryId}.zip: {result['Size'] / 1e6:.1f}MB zipped in {result['Seconds']:.1f}s", flush=True)
+            # record progress as it completes so an interrupted run keeps finished categories
+            manifest[categoryId] = result["Hash"]
+            writeAtomic(manifest_file, json.dumps(manifest, indent=2, sort_keys=True))
+
+    return results
+
+def chunkText(text: str, chunk_tokens: int) -> List[str]:
+    """Split text into chunks of at most chunk_tokens whitespace separated tokens, keeping the original spacing within a chunk"""
+    spans = [match.span() for match in re.finditer(r"\S+", text)]
+    return [
+        text[spans[i][0]:spans[min(i + chunk_tokens, len(spans)) - 1][1]]
+        for i in range(0, len(spans), chunk_tokens)
+    ]
+
+def chunkId(source: str, index: int, text: str) -> str:
+    """Stable id of a chunk, only changes when the chunk itself changes so indexed chunks can be skipped"""
+    return hashlib.sha256(f"{source}#{index}\n{text}".encode()).hexdigest()[:32]
+
+def shardCategory(source_zip: str, names: List[str], prefix: str, shards_dir: str, metadata: AssetMetadata, chunk_tokens: int, shard_size: int, compress: bool) -> dict:
+    """Chunk the entries of a category from the source zip into `category-<id>-<n>.jsonl[.gz]` shards"""
+    start = time.monotonic()
+    categoryId = metadata["CategoryId"]
+    extension = ".jsonl.gz" if compress else ".jsonl"
+    shards: List[dict] = []
+    file = None
+
+    def closeShard():
+        file.close()
+        shard = shards[-1]
+        os.replace(f"{shard['Path']}.tmp", shard["Path"])
+        shard["Sha256"] = sha256File(shard["Path"]).hexdigest()
+        shard["Size"] = os.path.getsize(shard["Path"])
+        shard["File"] = os.path.basename(shard.pop("Path"))
+
+    with zipfile.ZipFile(source_zip, "r") as source_ref:
+        for name in names:
+            source = metadata["AssetKeyPrefix"] + name[len(prefix):]
+            text = source_ref.read(name).decode("utf-8", errors="replace")
+            for index, chunk in enumerate(chunkText(text, chunk_tokens)):
+                if file is None or shards[-1]["Chunks"] == shard_size:
+                    if file is not None:
+                        closeShard()
+                    path = os.path.join(shards_dir, f"category-{categoryId}-{len(shards):05d}{extension}")
+                    shards.append({"Path": path, "Chunks": 0})
+                    file = gzip.open(f"{path}.tmp", "wt", encoding="utf-8") if compress else open(f"{path}.tmp", "w", encoding="utf-8")
+                record = {"id": chunkId(source, index, chunk), "source": source, "chunk": index, "text": chunk, **metadata}
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                shards[-1]["Chunks"] += 1
+    if file is not None:
+        closeShard()
+
+    # remove shards left over from a previous run that produced more of them
+    current = {shard["File"] for shard in shards}
+    for existing in os.listdir(shards_dir):
+        if existing.startswith(f"category-{categoryId}-") and existing.endswith(extension) and existing not in current:
+            os.remove(os.path.join(shards_dir, existing))
+
+    return {"Shards": shards, "Chunks": sum(shard["Chunks"] for shard in shards), "Seconds": time.monotonic() - start}
+
+def shardCategories(source_zip: str, shards_dir: str, categories: TCategoryMap, chunk_tokens: int = SHARD_CHUNK_TOKENS, shard_size: int = SHARD_SIZE, compress: bool = SHARD_COMPRESS, workers: Optional[int] = ZIP_WORKERS) -> dict:
+    """Write token budgeted JSONL chunk shards for every category of source_zip in a process pool, returns the shard manifest.
+
+    Each chunk record has a stable `id`, its `source` asset key and `chunk` index and the AssetMetadata fields.
+    `manifest.json` of the shards_dir lists the shards of every category, categories whose content and
+    settings are unchanged are skipped on the next run.
+    """
+    manifest_file = os.path.join(shards_dir, "manifest.json")
+    settings = {"ChunkTokens": chunk_tokens, "ShardSize": shard_size, "Compress": compress}
+    manifest = {**settings, "Categories": {}}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest["Categories"] = json.load(f)["Categories"]
+
+    with zipfile.ZipFile(source_zip, "r") as zip_ref:
+        entries = groupCategoryEntries(zip_ref)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for categoryId in sorted(entries):
+            metadata = categoryMetadata(categoryId, categories)
+            content_hash = hashlib.sha256(f"{categoryHash(entries[categoryId], metadata)}:{json.dumps(settings, sort_keys=True)}".encode()).hexdigest()
+            previous = manifest["Categories"].get(categoryId, {})
+            if previous.get("Hash") == content_hash and all(os.path.isfile(os.path.join(shards_dir, shard["File"])) for shard in previous["Shards"]):
+                print(f"  category-{categoryId}: {previous['Chunks']} chunks unchanged", flush=True)
+                continue
+            futures[categoryId] = (content_hash, executor.submit(
+                shardCategory,
+                source_zip,
+                [info.filename for info in entries[categoryId]],
+                f"{SOURCE_ZIP_NAME}/{categoryId}/",
+                shards_dir,
+                metadata,
+                chunk_tokens,
+                shard_size,
+                compress,
+            ))
+
+        for categoryId, (content_hash, future) in futures.items():
+            result = future.result()
+            print(f"  category-{categoryId}: {result['Chunks']} chunks in {len(result['Shards'])} shards in {result['Seconds']:.1f}s", flush=True)
+            manifest["Categories"][categoryId] = {"Hash": content_hash, "Chunks": result["Chunks"], "Shards": result["Shards"]}
+            writeAtomic(manifest_file, json.dumps(manifest, indent=2, sort_keys=True))
+
+    return manifest
+
+def main():
+    print("----------------------------------------------")
+    print("Building corpus dataset - SigmaLaw - Large Legal Text Corpus and Word Embeddings")
+
+    print("----------------------------------------------")
+
     os.makedirs(SOURCE_DIR, exist_ok=True)
     os.makedirs(PROCESSED_DIR, exist_ok=True)
     os.makedirs(ASSETS_DIR, exist_ok=True)
 
+    # the source zip is only needed to (re)build, skip the download when the assets are already built
+    if not SHARDS and not os.path.isfile(SOURCE_CASE_ZIP) and assetsBuilt(ASSETS_DIR):
+        print(f"Already built corpus dataset > {ASSETS_DIR}, remove {assetsManifestPath(ASSETS_DIR)} to rebuild")
+        print("----------------------------------------------")
+        return
+
     if not os.path.isfile(SOURCE_CASE_ZIP):
-        print(f"[Start] Downloading {SOURCE_CASE_ZIP} ...")
-        response = requests.get("https://osf.io/download/w3paz/", allow_redirects=True, timeout=GET_TIMEOUT)
-        with open(SOURCE_CASE_ZIP, "wb") as file:
-            file.write(response.content)
-        print(f"[Complete] Downloaded {SOURCE_CASE_ZIP}")
+        download(SOURCE_CASE_ZIP_URL, SOURCE_CASE_ZIP, sha256=SOURCE_CASE_ZIP_SHA256)
 
     if not os.path.isfile(PROCESSED_MAP_TXT):
-        print(f"[Start] Downloading {PROCESSED_MAP_TXT} ...")
-        response = requests.get("https://osf.io/download/khpwd/", allow_redirects=True, timeout=GET_TIMEOUT)
-        with open(PROCESSED_MAP_TXT, "wb") as file:
-            file.write(response.content)
-        print(f"[Complete] Downloaded {PROCESSED_MAP_TXT}")
+        download(MAP_TXT_URL, PROCESSED_MAP_TXT)
 
     categories: TCategoryMap = parseCategories(PROCESSED_MAP_TXT)
 
-    if not os.path.isdir(PROCESSED_CASES):
-        print(f"[Start] Unzipping {SOURCE_CASE_ZIP} -> {SOURCE_DIR} ...")
-        with zipfile.ZipFile(SOURCE_CASE_ZIP, "r") as zip_ref:
-            zip_ref.extractall(SOURCE_DIR)
-        shutil.move(os.path.join(SOURCE_DIR, SOURCE_ZIP_NAME), PROCESSED_CASES)
-        print(f"[Complete] Unzipped {SOURCE_CASE_ZIP} -> {SOURCE_DIR}")
-
-    print(f"[Start] Zipping processed assets to {ASSETS_DIR} ...")
-    os.chdir(PROCESSED_DIR)
-
-    dir_path = "./cases"
-    for subdir in os.listdir(dir_path):
-        subdir_path = os.path.join(dir_path, subdir)
-        if os.path.isdir(subdir_path):
-            categoryId = subdir
-            metadata = AssetMetadata(
-                **DEFAULT_METADATA,
-                CategoryId=categoryId,
-                Category=categories[categoryId],
-                OriginalLocation=f"https://osf.io/8mjcy#preprocessed_cases[cases_29404]/{categoryId}",
-                AssetKeyPrefix=f"/cases/{categoryId}/"
-            )
-
-            metadata_file = os.path.join("..", "assets", f"category-{categoryId}.zip.metadata")
-            with open(metadata_file, "w") as file:
-                json.dump(metadata, file, indent=2)
-
-            zip_file = os.path.join("..", "assets", f"category-{categoryId}.zip")
-            zip_dir = os.path.join("cases", subdir)
+    print(f"[Start] Zipping categories of {SOURCE_CASE_ZIP} to {ASSETS_DIR} ...")
+    start = time.monotonic()
+    results = zipCategories(SOURCE_CASE_ZIP, ASSETS_DIR, categories)
+    zipped = [result for result in results.values() if not result["Skipped"]]
+    print(f"[Complete] Zipped {len(zipped)} of {len(results)} categories to {ASSETS_DIR} in {time.monotonic() - start:.1f}s")
 
-            with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED) as zip_ref:
-                for root, dirs, files in os.walk(zip_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arc_name = os.path.relpath(file_path, start=zip_dir)
-                        zip_ref.write(file_path, arc_name)
+    if SHARDS:
+        os.makedirs(SHARDS_DIR, exist_ok=True)
+        print(f"[Start] Writing chunk shards of {SOURCE_CASE_ZIP} to {SHARDS_DIR} ...")
+        start = time.monotonic()
+        manifest = shardCategories(SOURCE_CASE_ZIP, SHARDS_DIR, categories)
+        chunks = sum(category["Chunks"] for category in manifest["Categories"].values())
+        print(f"[Complete] Wrote {chunks} chunks to {SHARDS_DIR} in {time.monotonic() - start:.1f}s")
 
-    os.chdir("..")
-    print(f"[Complete] Zipped all assets to {ASSETS_DIR}")
-else:
-    print("Already cached, nothing to build - delete the ASSETS_DIR to rebuild, and DIR to redownload and build from scratch")
+    print(f"Successfully built corpus dataset > {ASSETS_DIR}")
+    print("----------------------------------------------")
 
-print(f"Successfully built corpus dataset > {ASSETS_DIR}")
-print("----------------------------------------------")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import generate
+
+CONTENT = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves CONTENT with Range support, dropping the connection after `fail_after` bytes once"""
+
+    fail_after = None
+    requests = []
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        RangeHandler.requests.append(range_header)
+        start = 0
+        if range_header:
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(CONTENT)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        body = CONTENT[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if RangeHandler.fail_after is not None:
+            self.wfile.write(body[: RangeHandler.fail_after])
+            RangeHandler.fail_after = None
+            self.wfile.flush()
+            self.connection.close()
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_retry_backoff(monkeypatch):
+    monkeypatch.setattr(generate, "DOWNLOAD_RETRY_BACKOFF", 0)
+
+
+@pytest.fixture
+def server_url():
+    RangeHandler.fail_after = None
+    RangeHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/file"
+    server.shutdown()
+
+
+def test_download(server_url, tmp_path):
+    path = str(tmp_path / "source.zip")
+    sha256 = hashlib.sha256(CONTENT).hexdigest()
+
+    assert generate.download(server_url, path, sha256=sha256) == sha256
+    assert open(path, "rb").read() == CONTENT
+    assert not os.path.exists(f"{path}.part")
+
+
+def test_download_resumes_interrupted(server_url, tmp_path):
+    path = str(tmp_path / "source.zip")
+    RangeHandler.fail_after = 1024 * 1024
+
+    generate.download(server_url, path, sha256=hashlib.sha256(CONTENT).hexdigest())
+
+    assert open(path, "rb").read() == CONTENT
+    assert RangeHandler.requests == [None, f"bytes={1024 * 1024}-"]
+
+
+def test_download_resumes_partial_file(server_url, tmp_path):
+    path = str(tmp_path / "source.zip")
+    with open(f"{path}.part", "wb") as file:
+        file.write(CONTENT[:1000])
+
+    generate.download(server_url, path)
+
+    assert open(path, "rb").read() == CONTENT
+    assert RangeHandler.requests == ["bytes=1000-"]
+
+
+def test_download_complete_partial_file(server_url, tmp_path):
+    path = str(tmp_path / "source.zip")
+    with open(f"{path}.part", "wb") as file:
+        file.write(CONTENT)
+
+    generate.download(server_url, path)
+
+    assert open(path, "rb").read() == CONTENT
+    assert RangeHandler.requests == [f"bytes={len(CONTENT)}-"]
+
+
+def test_download_restarts_oversized_partial_file(server_url, tmp_path):
+    path = str(tmp_path / "source.zip")
+    with open(f"{path}.part", "wb") as file:
+        file.write(CONTENT + b"stale")
+
+    generate.download(server_url, path, sha256=hashlib.sha256(CONTENT).hexdigest())
+
+    assert open(path, "rb").read() == CONTENT
+    assert RangeHandler.requests == [f"bytes={len(CONTENT) + 5}-", None]
+
+
+def test_download_checksum_mismatch(server_url, tmp_path):
+    path = str(tmp_path / "source.zip")
+
+    with pytest.raises(ValueError):
+        generate.download(server_url, path, sha256="0" * 64)
+    assert not os.path.exists(path)
+    assert not os.path.exists(f"{path}.part")
+
+
+def write_source_zip(source_zip, files):
+    """Write files to a zip laid out like the SigmaLaw source, `<root>/<categoryId>/<file>`"""
+    with zipfile.ZipFile(source_zip, "a") as zip_ref:
+        for relpath, content in files.items():
+            zip_ref.writestr(f"{generate.SOURCE_ZIP_NAME}/{relpath}", content)
+
+
+def test_zip_categories_incremental(tmp_path):
+    source_zip = str(tmp_path / "source.zip")
+    assets_dir = tmp_path / "assets"
+    assets_dir.mkdir()
+    categories = {"1": "Contract", "2": "Tort"}
+    write_source_zip(source_zip, {"1/a.txt": "case a", "1/b.txt": "case b", "2/c.txt": "case c"})
+
+    results = generate.zipCategories(source_zip, str(assets_dir), categories, workers=2)
+    assert [result["Skipped"] for result in results.values()] == [False, False]
+    with zipfile.ZipFile(assets_dir / "category-1.zip") as zip_ref:
+        assert sorted(zip_ref.namelist()) == ["a.txt", "b.txt"]
+        assert zip_ref.read("a.txt") == b"case a"
+    metadata = json.loads((assets_dir / "category-2.zip.metadata").read_text())
+    assert metadata["Category"] == "Tort"
+    assert metadata["AssetKeyPrefix"] == "/cases/2/"
+
+    write_source_zip(source_zip, {"2/d.txt": "case d"})
+    results = generate.zipCategories(source_zip, str(assets_dir), categories, workers=2)
+    assert results["1"]["Skipped"] is True
+    assert results["2"]["Skipped"] is False
+    with zipfile.ZipFile(assets_dir / "category-2.zip") as zip_ref:
+        assert sorted(zip_ref.namelist()) == ["c.txt", "d.txt"]
+    # the dataset stack only accepts zips, their metadata and dotfiles in the assets dir
+    assert sorted(os.listdir(assets_dir)) == ["category-1.zip", "category-1.zip.metadata", "category-2.zip", "category-2.zip.metadata"]
+    assert json.loads((tmp_path / "assets-manifest.json").read_text()).keys() == {"1", "2"}
+
+
+def test_main_skips_built_assets(tmp_path, monkeypatch):
+    source_zip = str(tmp_path / "source.zip")
+    assets_dir = tmp_path / "assets"
+    assets_dir.mkdir()
+    write_source_zip(source_zip, {"1/a.txt": "case a", "2/c.txt": "case c"})
+    generate.zipCategories(source_zip, str(assets_dir), {"1": "Contract", "2": "Tort"}, workers=1)
+    os.remove(source_zip)
+
+    def download(url, path, sha256=None):
+        raise AssertionError(f"unexpected download of {path}")
+
+    monkeypatch.setattr(generate, "download", download)
+    monkeypatch.setattr(generate, "SHARDS", False)
+    monkeypatch.setattr(generate, "SOURCE_DIR", str(tmp_path / "source"))
+    monkeypatch.setattr(generate, "SOURCE_CASE_ZIP", source_zip)
+    monkeypatch.setattr(generate, "PROCESSED_DIR", str(tmp_path / "processed"))
+    monkeypatch.setattr(generate, "ASSETS_DIR", str(assets_dir))
+    generate.main()
+
+    os.remove(assets_dir / "category-2.zip")
+    with pytest.raises(AssertionError, match="unexpected download"):
+        generate.main()
+
+
+def test_chunk_text():
+    assert generate.chunkText("a b  c\nd e", 2) == ["a b", "c\nd", "e"]
+    assert generate.chunkText("  ", 2) == []
+
+
+def test_shard_categories(tmp_path):
+    source_zip = str(tmp_path / "source.zip")
+    shards_dir = tmp_path / "shards"
+    shards_dir.mkdir()
+    categories = {"1": "Contract", "2": "Tort"}
+    write_source_zip(source_zip, {"1/a.txt": "one two three four five", "1/b.txt": "six", "2/c.txt": "seven eight"})
+
+    manifest = generate.shardCategories(source_zip, str(shards_dir), categories, chunk_tokens=2, shard_size=2, compress=True, workers=2)
+    category = manifest["Categories"]["1"]
+    assert category["Chunks"] == 4
+    assert [shard["Chunks"] for shard in category["Shards"]] == [2, 2]
+
+    with gzip.open(shards_dir / category["Shards"][0]["File"], "rt") as file:
+        records = [json.loads(line) for line in file]
+    assert [record["text"] for record in records] == ["one two", "three four"]
+    assert records[0]["source"] == "/cases/1/a.txt"
+    assert records[0]["Category"] == "Contract"
+    ids = [record["id"] for record in records]
+
+    # unchanged categories are skipped and chunk ids are stable across runs
+    write_source_zip(source_zip, {"2/d.txt": "nine"})
+    manifest = generate.shardCategories(source_zip, str(shards_dir), categories, chunk_tokens=2, shard_size=2, compress=True, workers=2)
+    assert manifest["Categories"]["1"] == category
+    assert manifest["Categories"]["2"]["Chunks"] == 2
+    with gzip.open(shards_dir / category["Shards"][0]["File"], "rt") as file:
+        assert [json.loads(line)["id"] for line in file] == ids
@@ -0,0 +1,157 @@
+"""
+Open-loop load generator for the local invocation server (or any `/invocations` endpoint over HTTP).
+
+Replays a recorded request mix at a target rate and reports the achieved rate, error rate,
+latency percentiles and a latency histogram. The mix is a JSONL file with one request body
+per line, or `{"body": {...}, "weight": n}` to replay a request n times as often as the others.
+
+Usage:
+    python load_generator.py --url http://127.0.0.1:8080 --requests mix.jsonl --qps 20 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List, Optional
+from urllib.parse import urlparse
+
+# upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+
+def load_request_mix(path: str) -> List[bytes]:
+    """Request bodies of the mix, repeated by their weight"""
+    mix: List[bytes] = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if isinstance(request, dict) and "body" in request:
+                mix.extend([json.dumps(request["body"]).encode()] * int(request.get("weight", 1)))
+            else:
+                mix.append(json.dumps(request).encode())
+    return mix
+
+
+async def invoke(host: str, port: int, body: bytes, timeout: float) -> int:
+    """POST body to /invocations on a new connection, returns the response status"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(
+            (
+                f"POST /invocations HTTP/1.1\r\nHost: {host}:{port}\r\n"
+                f"Content-Type: application/json\r\nAccept: application/json\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+            ).encode()
+            + body
+        )
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        await asyncio.wait_for(reader.read(), timeout)
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies_ms: List[float], errors: int, elapsed: float) -> dict:
+    total = len(latencies_ms) + errors
+    latencies_ms = sorted(latencies_ms)
+    histogram = {}
+    lower = 0.0
+    for upper in HISTOGRAM_BUCKETS_MS:
+        label = f"<={upper:g}ms" if upper != float("inf") else f">{lower:g}ms"
+        histogram[label] = sum(1 for latency in latencies_ms if lower < latency <= upper)
+        lower = upper
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "achieved_qps": total / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies_ms, 0.5),
+            "p90": percentile(latencies_ms, 0.9),
+            "p99": percentile(latencies_ms, 0.99),
+            "max": latencies_ms[-1] if latencies_ms else None,
+        },
+        "histogram": histogram,
+    }
+
+
+async def run_load(
+    url: str,
+    mix: List[bytes],
+    qps: float,
+    num_requests: int,
+    poisson: bool = False,
+    timeout: float = 60.0,
+    seed: int = 0,
+) -> dict:
+    """
+    Send num_requests requests drawn from the mix at the target qps, without waiting for responses
+    to send the next one, so server saturation shows up as latency and errors rather than a lower rate.
+    """
+    parsed = urlparse(url)
+    host, port = parsed.hostname, parsed.port or 80
+    rng = random.Random(seed)
+    latencies_ms: List[float] = []
+    errors = 0
+
+    async def send(body: bytes):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            status = await invoke(host, port, body, timeout)
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            errors += 1
+            return
+        if 200 <= status < 300:
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+        else:
+            errors += 1
+
+    tasks = []
+    start = time.perf_counter()
+    next_send = start
+    for _ in range(num_requests):
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(rng.choice(mix))))
+        next_send += rng.expovariate(qps) if poisson else 1.0 / qps
+    await asyncio.gather(*tasks)
+    return summarize(latencies_ms, errors, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--requests", required=True, help="JSONL request mix")
+    parser.add_argument("--qps", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load at the target qps")
+    parser.add_argument("--poisson", action="store_true", help="exponential inter-arrival times instead of a fixed rate")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run_load(
+            args.url,
+            load_request_mix(args.requests),
+            args.qps,
+            int(args.qps * args.duration),
+            poisson=args.poisson,
+            timeout=args.timeout,
+        )
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
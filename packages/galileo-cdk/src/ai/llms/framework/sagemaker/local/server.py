@@ -0,0 +1,126 @@
+"""
+Local stand-in for a SageMaker inference endpoint around a custom `inference.py` handler.
+
+Implements the `/ping` and `/invocations` container contract: `model_fn` is called once at
+startup and every invocation runs `input_fn` -> `predict_fn` -> `output_fn` (JSON by default,
+like the HuggingFace inference toolkit), with at most `--workers` predictions running at once.
+
+Usage:
+    MANAGED_EMBEDDINGS_MODEL_IDS=... python server.py --handler ../../../models/managed-embeddings/custom.asset/code/inference.py --model-dir ./model --workers 4
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import ModuleType
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_PORT = 8080  # port SageMaker sends requests to
+JSON_CONTENT_TYPE = "application/json"
+
+
+def load_handler(handler_path: str) -> ModuleType:
+    """Import the handler module from its path, with its directory on sys.path like the `code/` folder of a model"""
+    handler_path = os.path.abspath(handler_path)
+    code_dir = os.path.dirname(handler_path)
+    if code_dir not in sys.path:
+        sys.path.insert(0, code_dir)
+    spec = importlib.util.spec_from_file_location("inference", handler_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class InvocationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler: ModuleType, model_dir: str, workers: int = 1):
+        super().__init__(address, InvocationRequestHandler)
+        self.handler = handler
+        self.workers = threading.BoundedSemaphore(workers)
+
+        start = time.perf_counter()
+        self.model = handler.model_fn(model_dir)
+        logger.info(f"model_fn completed in {time.perf_counter() - start:.2f}s")
+
+    def invoke(self, body: bytes, content_type: str, accept: str):
+        handler = self.handler
+        if hasattr(handler, "input_fn"):
+            data = handler.input_fn(body, content_type)
+        else:
+            data = json.loads(body)
+        with self.workers:
+            prediction = handler.predict_fn(data, self.model)
+        if hasattr(handler, "output_fn"):
+            return handler.output_fn(prediction, accept)
+        return json.dumps(prediction)
+
+
+class InvocationRequestHandler(BaseHTTPRequestHandler):
+    server: InvocationServer
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self, status: int, body: bytes = b"", content_type: str = JSON_CONTENT_TYPE):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/ping":
+            self._respond(200)
+        else:
+            self._respond(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/invocations":
+            self._respond(404)
+            return
+
+        content_type = self.headers.get("Content-Type", JSON_CONTENT_TYPE)
+        accept = self.headers.get("Accept", JSON_CONTENT_TYPE)
+        try:
+            response = self.server.invoke(body, content_type, accept)
+        except Exception as error:
+            logger.exception("Invocation failed")
+            self._respond(500, json.dumps({"error": str(error)}).encode())
+            return
+        if isinstance(response, str):
+            response = response.encode()
+        self._respond(200, response, accept if accept != "*/*" else JSON_CONTENT_TYPE)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handler", required=True, help="path to the inference.py handler")
+    parser.add_argument("--model-dir", required=True, help="directory passed to model_fn")
+    parser.add_argument("--workers", type=int, default=1, help="maximum concurrent predict_fn calls")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = InvocationServer((args.host, args.port), load_handler(args.handler), args.model_dir, args.workers)
+    logger.info(f"Serving /ping and /invocations on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
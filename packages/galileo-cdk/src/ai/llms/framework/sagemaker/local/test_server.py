@@ -0,0 +1,63 @@
+import asyncio
+import json
+import threading
+import urllib.request
+
+import pytest
+
+from load_generator import load_request_mix, run_load
+from server import InvocationServer, load_handler
+
+HANDLER = '''
+import time
+
+def model_fn(model_dir):
+    return {"model_dir": model_dir}
+
+def predict_fn(data, model):
+    if data.get("fail"):
+        raise ValueError("failed")
+    time.sleep(0.01)
+    return {"echo": data["input"], "model_dir": model["model_dir"]}
+'''
+
+
+@pytest.fixture
+def server_url(tmp_path):
+    handler_path = tmp_path / "inference.py"
+    handler_path.write_text(HANDLER)
+    server = InvocationServer(("127.0.0.1", 0), load_handler(str(handler_path)), "/opt/ml/model", workers=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_ping_and_invocations(server_url):
+    with urllib.request.urlopen(f"{server_url}/ping") as response:
+        assert response.status == 200
+
+    request = urllib.request.Request(
+        f"{server_url}/invocations",
+        data=json.dumps({"input": "I love Berlin"}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        assert json.loads(response.read()) == {"echo": "I love Berlin", "model_dir": "/opt/ml/model"}
+
+
+def test_load_generator(server_url, tmp_path):
+    mix_path = tmp_path / "mix.jsonl"
+    mix_path.write_text(
+        json.dumps({"body": {"input": "I love Berlin"}, "weight": 3}) + "\n" + json.dumps({"fail": True}) + "\n"
+    )
+    mix = load_request_mix(str(mix_path))
+    assert len(mix) == 4
+
+    report = asyncio.run(run_load(server_url, mix, qps=200, num_requests=40))
+    assert report["requests"] == 40
+    assert 0 < report["errors"] < 40
+    assert report["error_rate"] == report["errors"] / 40
+    assert sum(report["histogram"].values()) == 40 - report["errors"]
+    assert report["latency_ms"]["p50"] >= 10
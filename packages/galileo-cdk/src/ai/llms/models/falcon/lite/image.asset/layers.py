@@ -4,13 +4,16 @@
 ########################################################################
 from text_generation_server.utils.gptq.quant_linear import QuantLinear
 from accelerate import init_empty_weights
+from contextlib import contextmanager
+from loguru import logger
+import resource
 import torch
 import torch.distributed
 import os
 
 from torch import nn
 from torch.nn import functional as F
-from typing import List
+from typing import List, Optional
 
 HAS_BITS_AND_BYTES = True
 try:
@@ -20,6 +23,108 @@ try:
 except ImportError:
     HAS_BITS_AND_BYTES = False
 
+HAS_INT8_PACK_MM = hasattr(torch, "_weight_int8pack_mm")
+
+# backends implementing reduce_scatter_tensor, gloo only does on recent torch releases
+REDUCE_SCATTER_BACKENDS = {"nccl"}
+
+# bytes of a shard read from the memory-mapped weights at once while copying it into place
+LOAD_BLOCK_BYTES = 64 * 1024 * 1024
+
+LOG_LOAD_PEAK_MEMORY = os.getenv("LOG_LOAD_PEAK_MEMORY", "false").lower() == "true"
+
+
+def _rss_mb() -> Optional[float]:
+    """Current resident set size, linux only"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def log_peak_memory(prefix: str):
+    """
+    Log the memory used while loading `prefix`, enabled with `LOG_LOAD_PEAK_MEMORY=true`.
+
+    Logs the resident set size before and after the layer and its delta, the process peak rss
+    (a high-water mark over the whole process lifetime) and the peak cuda memory of the layer.
+    """
+    if not LOG_LOAD_PEAK_MEMORY:
+        yield
+        return
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    rss_before = _rss_mb()
+    yield
+    rss_after = _rss_mb()
+    message = f"Loaded {prefix}:"
+    if rss_before is not None and rss_after is not None:
+        message += f" rss {rss_before:.1f}MB -> {rss_after:.1f}MB (delta {rss_after - rss_before:+.1f}MB),"
+    # ru_maxrss is reported in KB on linux
+    message += f" process peak rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB"
+    if torch.cuda.is_available():
+        message += f", layer peak cuda {torch.cuda.max_memory_allocated() / 1024 ** 2:.1f}MB"
+    logger.info(message)
+
+
+def get_sharded_into(weights, tensor_name: str, out: torch.Tensor, dim: int) -> torch.Tensor:
+    """
+    Copy this rank's shard of `tensor_name` into the preallocated `out`.
+
+    The shard is read from the memory-mapped safetensors slice in blocks of rows of at most
+    `LOAD_BLOCK_BYTES`, so the temporary copy is bounded by the block rather than the shard size.
+    """
+    slice_ = weights._get_slice(tensor_name)
+    world_size = weights.process_group.size()
+    rank = weights.process_group.rank()
+
+    size = slice_.get_shape()[dim]
+    assert (
+        size % world_size == 0
+    ), f"The choosen size {size} is not compatible with sharding on {world_size} shards" #nosec
+    block_size = size // world_size
+    start = rank * block_size
+    stop = (rank + 1) * block_size
+
+    if dim not in (0, 1):
+        raise NotImplementedError("Let's make that generic when needed")
+    rows = out.shape[0]
+    row_bytes = out[0].numel() * out.element_size() if rows else 1
+    rows_per_block = max(1, LOAD_BLOCK_BYTES // row_bytes)
+    for row in range(0, rows, rows_per_block):
+        row_stop = min(row + rows_per_block, rows)
+        if dim == 0:
+            tensor = slice_[start + row:start + row_stop]
+        else:
+            tensor = slice_[row:row_stop, start:stop]
+        out[row:row_stop].copy_(tensor)
+    return out
+
+
+def get_multi_sharded_into(weights, tensor_names: List[str], dim: int) -> torch.Tensor:
+    """
+    This rank's shards (split on dim 0) of every tensor, concatenated along `dim` into a single
+    preallocated tensor like `torch.cat([weights.get_sharded(name, dim=0) ...], dim=dim)`.
+    """
+    world_size = weights.process_group.size()
+    shapes = []
+    for name in tensor_names:
+        shape = list(weights.get_shape(name))
+        shape[0] //= world_size
+        shapes.append(shape)
+    out_shape = list(shapes[0])
+    out_shape[dim] = sum(shape[dim] for shape in shapes)
+    out = torch.empty(out_shape, dtype=weights.dtype, device=weights.device)
+
+    offset = 0
+    for name, shape in zip(tensor_names, shapes):
+        get_sharded_into(weights, name, out.narrow(dim, offset, shape[dim]), dim=0)
+        offset += shape[dim]
+    return out
+
 
 # Monkey patching
 @classmethod
@@ -133,6 +238,50 @@ class Linear8bitLt(nn.Module):
         return out
 
 
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    Linear layer storing its weight as int8 with one scale per output channel.
+
+    Unlike `Linear8bitLt` this does not depend on bitsandbytes or CUDA, the weight is
+    dequantized on the fly, or fed to the native int8 matmul on CPU where torch provides it.
+
+    Layer level only: the TGI 0.9.2 launcher and server only accept `--quantize bitsandbytes|gptq`,
+    so `HF_MODEL_QUANTIZE=int8` is rejected before any weights are loaded in the image.
+    """
+
+    def __init__(
+        self,
+        weight,
+        bias,
+    ) -> None:
+        super().__init__()
+        scale = weight.abs().amax(dim=1).float().clamp(min=1e-8) / 127.0
+        qweight = torch.round(weight.float() / scale[:, None]).clamp(-127, 127)
+        self.weight = nn.Parameter(qweight.to(torch.int8), requires_grad=False)
+        self.scale = nn.Parameter(scale.to(weight.dtype), requires_grad=False)
+        if bias is not None:
+            self.bias = nn.Parameter(bias)
+        else:
+            self.bias = None
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        scale = self.scale.to(input.dtype)
+        out = None
+        if HAS_INT8_PACK_MM and input.device.type == "cpu":
+            try:
+                out = torch._weight_int8pack_mm(
+                    input.reshape(-1, input.shape[-1]).contiguous(), self.weight, scale
+                ).reshape(*input.shape[:-1], -1)
+            except RuntimeError:
+                # private op, not every dtype and shape is supported
+                pass
+        if out is None:
+            out = F.linear(input, self.weight.to(input.dtype)) * scale
+        if self.bias is not None:
+            out += self.bias
+        return out
+
+
 def get_linear(weight, bias, quantize):
     if quantize is None:
         linear = FastLinear(weight, bias)
@@ -145,6 +294,9 @@ def get_linear(weight, bias, quantize):
         )
         if bias is not None:
             linear.bias = nn.Parameter(bias)
+    elif quantize == "int8":
+        # not selectable through text-generation-launcher, see Int8WeightOnlyLinear
+        linear = Int8WeightOnlyLinear(weight, bias)
     elif quantize == "gptq":
         try:
             qweight, qzeros, scales, g_idx, bits, groupsize = weight
@@ -168,6 +320,55 @@ def get_linear(weight, bias, quantize):
     return linear
 
 
+def reduce_scatter_tokens(input: torch.Tensor, process_group) -> torch.Tensor:
+    """
+    Sum `input` across ranks and keep only this rank's block of the token dimension (dim 0).
+
+    The token dimension is zero padded to a multiple of the world size, `all_gather_tokens`
+    restores the full tensor given the original number of tokens.
+    """
+    world_size = process_group.size()
+    num_tokens = input.shape[0]
+    block_size = -(-num_tokens // world_size)
+    padding = block_size * world_size - num_tokens
+    if padding:
+        input = F.pad(input, (0, 0) * (input.dim() - 1) + (0, padding))
+    input = input.contiguous()
+
+    # the path is chosen by capability, every rank must run the same collective
+    if has_reduce_scatter(process_group):
+        out = input.new_empty(block_size, *input.shape[1:])
+        torch.distributed.reduce_scatter_tensor(out, input, group=process_group)
+        return out
+
+    # reduce everything and keep our block
+    torch.distributed.all_reduce(input, group=process_group)
+    rank = process_group.rank()
+    return input[rank * block_size: (rank + 1) * block_size].clone()
+
+
+def has_reduce_scatter(process_group) -> bool:
+    return (
+        hasattr(torch.distributed, "reduce_scatter_tensor")
+        and torch.distributed.get_backend(process_group) in REDUCE_SCATTER_BACKENDS
+    )
+
+
+def all_gather_tokens(
+    input: torch.Tensor, process_group, num_tokens: Optional[int] = None
+) -> torch.Tensor:
+    """
+    Inverse of `reduce_scatter_tokens`, gather every rank's block of tokens and drop the padding
+    when given the original number of tokens.
+    """
+    world_size = process_group.size()
+    world_out = input.new_empty(input.shape[0] * world_size, *input.shape[1:])
+    torch.distributed.all_gather_into_tensor(
+        world_out, input.contiguous(), group=process_group
+    )
+    return world_out[:num_tokens]
+
+
 class SuperLayer(nn.Module):
     def __init__(self, linear):
         super().__init__()
@@ -184,7 +385,8 @@ class TensorParallelHead(SuperLayer):
 
     @staticmethod
     def load(config, prefix: str, weights):
-        weight = weights.get_sharded(f"{prefix}.weight", dim=0)
+        with log_peak_memory(prefix):
+            weight = weights.get_sharded(f"{prefix}.weight", dim=0)
 
         # GPTQ doesn't quantize heads (nor embeddings)
         if config.quantize == "gptq":
@@ -233,59 +435,134 @@ class TensorParallelHead(SuperLayer):
         world_output = torch.cat(world_output, dim=-1)
         return world_output
 
+    def forward_topk(self, input: torch.Tensor, k: int):
+        """
+        Return the `k` largest logits and their vocabulary ids without gathering the full vocabulary.
+
+        Every rank selects the top-k of its own shard and only those `k` values and ids are
+        gathered and merged. Sampling that needs the full distribution should use `forward`.
+        The TGI 0.9.2 sampler only calls `forward`, so this is not used on the `lm_head` path yet.
+        """
+        world_size = self.process_group.size()
+        if world_size == 1:
+            values, indices = torch.topk(super().forward(input), k, dim=-1)
+            return values, indices
+
+        local_out = super().forward(input)
+        out_dim = local_out.shape[-1]
+        if k > out_dim:
+            # Shards are evenly sized, so every rank takes this fallback together
+            values, indices = torch.topk(self.forward(input), k, dim=-1)
+            return values, indices
+
+        local_values, local_indices = torch.topk(local_out, k, dim=-1)
+        # translate shard local ids to global vocabulary ids
+        local_indices += self.process_group.rank() * out_dim
+
+        world_values = [torch.empty_like(local_values) for _ in range(world_size)]
+        world_indices = [torch.empty_like(local_indices) for _ in range(world_size)]
+        torch.distributed.all_gather(
+            world_values, local_values, group=self.process_group)
+        torch.distributed.all_gather(
+            world_indices, local_indices, group=self.process_group)
+
+        values, top = torch.topk(torch.cat(world_values, dim=-1), k, dim=-1)
+        indices = torch.gather(torch.cat(world_indices, dim=-1), -1, top)
+        return values, indices
+
 
 class TensorParallelColumnLinear(SuperLayer):
+    def __init__(self, linear, process_group=None, sequence_parallel=False):
+        super().__init__(linear)
+        self.process_group = process_group
+        self.sequence_parallel = sequence_parallel
+
     @classmethod
-    def load(cls, config, prefix: str, weights, bias: bool):
-        return cls.load_multi(config, [prefix], weights, bias, dim=0)
+    def load(cls, config, prefix: str, weights, bias: bool, sequence_parallel: bool = False):
+        return cls.load_multi(
+            config, [prefix], weights, bias, dim=0, sequence_parallel=sequence_parallel
+        )
 
     @classmethod
-    def load_multi(cls, config, prefixes: List[str], weights, bias: bool, dim: int):
-        weight = weights.get_multi_weights_col(
-            prefixes, quantize=config.quantize, dim=dim
+    def load_multi(
+        cls,
+        config,
+        prefixes: List[str],
+        weights,
+        bias: bool,
+        dim: int,
+        sequence_parallel: bool = False,
+    ):
+        with log_peak_memory(",".join(prefixes)):
+            if config.quantize == "gptq":
+                weight = weights.get_multi_weights_col(
+                    prefixes, quantize=config.quantize, dim=dim
+                )
+            else:
+                # copy each shard into its slice of the final weight, no per prefix copies to concatenate
+                weight = get_multi_sharded_into(
+                    weights, [f"{p}.weight" for p in prefixes], dim=dim
+                )
+
+            if bias:
+                bias = get_multi_sharded_into(
+                    weights, [f"{p}.bias" for p in prefixes], dim=0
+                )
+            else:
+                bias = None
+            linear = get_linear(weight, bias, config.quantize)
+        return cls(
+            linear,
+            process_group=weights.process_group,
+            sequence_parallel=sequence_parallel,
         )
 
-        if bias:
-            b = [weights.get_sharded(f"{p}.bias", dim=0) for p in prefixes]
-            bias = torch.cat(b, dim=dim)
-        else:
-            bias = None
-        linear = get_linear(weight, bias, config.quantize)
-        return cls(linear)
+    def forward(self, input: torch.Tensor, num_tokens: Optional[int] = None) -> torch.Tensor:
+        if self.sequence_parallel and self.process_group.size() > 1:
+            # input is this rank's block of tokens from a sequence parallel row linear or embedding,
+            # gather all of them before the matmul, `num_tokens` drops the padding
+            input = all_gather_tokens(input, self.process_group, num_tokens)
+        return super().forward(input)
 
 
 class TensorParallelRowLinear(SuperLayer):
-    def __init__(self, linear, process_group):
+    def __init__(self, linear, process_group, sequence_parallel=False):
         super().__init__(linear)
         self.process_group = process_group
+        self.sequence_parallel = sequence_parallel
 
     @classmethod
-    def load(cls, config, prefix: str, weights, bias: bool):
-        weight = weights.get_multi_weights_row(
-            prefix, quantize=config.quantize)
-
-        if bias and weights.process_group.rank() == 0:
-            # Rank is only on the first rank process
-            bias = weights.get_tensor(f"{prefix}.bias")
-        else:
-            bias = None
+    def load(cls, config, prefix: str, weights, bias: bool, sequence_parallel: bool = False):
+        with log_peak_memory(prefix):
+            weight = weights.get_multi_weights_row(
+                prefix, quantize=config.quantize)
+
+            if bias and weights.process_group.rank() == 0:
+                # Rank is only on the first rank process
+                bias = weights.get_tensor(f"{prefix}.bias")
+            else:
+                bias = None
+            linear = get_linear(weight, bias, config.quantize)
         return cls(
-            get_linear(weight, bias, config.quantize),
+            linear,
             process_group=weights.process_group,
+            sequence_parallel=sequence_parallel,
         )
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
         out = super().forward(input)
         if self.process_group.size() > 1:
+            if self.sequence_parallel:
+                # output stays sharded along the tokens, a sequence parallel column linear gathers them
+                return reduce_scatter_tokens(out, self.process_group)
             torch.distributed.all_reduce(out, group=self.process_group)
         return out
 
 
 class TensorParallelEmbedding(nn.Module):
-    def __init__(self, prefix: str, weights, reduce=True):
+    def __init__(self, prefix: str, weights, reduce=True, sequence_parallel=False):
         super().__init__()
-        weight = weights.get_sharded(f"{prefix}.weight", dim=0)
-        num_embeddings = weights.get_shape(f"{prefix}.weight")[0]
+        num_embeddings, embedding_dim = weights.get_shape(f"{prefix}.weight")
 
         process_group = weights.process_group
 
@@ -298,9 +575,17 @@ class TensorParallelEmbedding(nn.Module):
         self.null_idx = block_size
         self.process_group = weights.process_group
         self.reduce = reduce
+        self.sequence_parallel = sequence_parallel
 
         """Additional 0 entry used for masking"""
-        self.weight = nn.Parameter(F.pad(weight, (0, 0, 0, 1)))
+        # allocated once with the extra row, padding the loaded shard would briefly double it
+        with log_peak_memory(prefix):
+            weight = torch.empty(
+                block_size + 1, embedding_dim, dtype=weights.dtype, device=weights.device
+            )
+            get_sharded_into(weights, f"{prefix}.weight", weight[:block_size], dim=0)
+            weight[block_size].zero_()
+        self.weight = nn.Parameter(weight)
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
         # default all out of bounds values to `self.null_idx` that will then be mapped to 0
@@ -312,6 +597,9 @@ class TensorParallelEmbedding(nn.Module):
         )
         out = torch.nn.functional.embedding(input, self.weight)
         if self.reduce and self.process_group.size() > 1:
+            if self.sequence_parallel:
+                # output stays sharded along the tokens, a sequence parallel column linear gathers them
+                return reduce_scatter_tokens(out, self.process_group)
             torch.distributed.all_reduce(out, group=self.process_group)
         return out
 
@@ -0,0 +1,281 @@
+import os
+import sys
+import tempfile
+import types
+
+import torch
+import torch.distributed
+import torch.multiprocessing as mp
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+try:
+    import text_generation_server.utils.gptq.quant_linear
+except ImportError:
+    # layers.py only needs QuantLinear from TGI, which is only installed in the image
+    for name in (
+        "text_generation_server",
+        "text_generation_server.utils",
+        "text_generation_server.utils.gptq",
+        "text_generation_server.utils.gptq.quant_linear",
+    ):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["text_generation_server.utils.gptq.quant_linear"].QuantLinear = type("QuantLinear", (), {})
+
+import layers
+from layers import (
+    FastLinear,
+    Int8WeightOnlyLinear,
+    TensorParallelColumnLinear,
+    TensorParallelEmbedding,
+    TensorParallelHead,
+    TensorParallelRowLinear,
+    all_gather_tokens,
+)
+
+WORLD_SIZE = 2
+HIDDEN = 16
+VOCAB = 64
+
+
+def _worker(rank, fn, tmp):
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"file://{os.path.join(tmp, 'init')}", rank=rank, world_size=WORLD_SIZE
+    )
+    try:
+        with torch.inference_mode():
+            fn(rank, torch.distributed.group.WORLD, os.path.join(tmp, f"model-{rank}.safetensors"))
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+class Config:
+    def __init__(self, quantize=None):
+        self.quantize = quantize
+
+
+class Weights:
+    """Minimal stand-in for `text_generation_server.utils.weights.Weights` over a safetensors file"""
+
+    def __init__(self, tensors, process_group, filename):
+        save_file(tensors, filename)
+        self.handle = safe_open(filename, framework="pt")
+        self.process_group = process_group
+        self.dtype = torch.float32
+        self.device = torch.device("cpu")
+
+    def _get_slice(self, tensor_name):
+        return self.handle.get_slice(tensor_name)
+
+    def get_shape(self, tensor_name):
+        return self._get_slice(tensor_name).get_shape()
+
+    def get_tensor(self, tensor_name):
+        return self.handle.get_tensor(tensor_name)
+
+    def get_sharded(self, tensor_name, dim):
+        tensor = self.get_tensor(tensor_name)
+        block_size = tensor.shape[dim] // self.process_group.size()
+        return tensor.narrow(dim, self.process_group.rank() * block_size, block_size)
+
+    def get_multi_weights_col(self, prefixes, quantize, dim):
+        return torch.cat([self.get_sharded(f"{p}.weight", dim=0) for p in prefixes], dim=dim)
+
+    def get_multi_weights_row(self, prefix, quantize):
+        return self.get_sharded(f"{prefix}.weight", dim=1)
+
+
+def run_distributed(fn):
+    with tempfile.TemporaryDirectory() as tmp:
+        mp.spawn(_worker, args=(fn, tmp), nprocs=WORLD_SIZE)
+
+
+def _check_head_topk(rank, process_group, filename):
+    torch.manual_seed(0)
+    weight = torch.randn(VOCAB, HIDDEN)
+    input = torch.randn(3, HIDDEN)
+    block_size = VOCAB // WORLD_SIZE
+    head = TensorParallelHead(
+        FastLinear(weight[rank * block_size : (rank + 1) * block_size], None),
+        process_group=process_group,
+    )
+
+    expected = torch.topk(input @ weight.T, 5, dim=-1)
+    values, indices = head.forward_topk(input, 5)
+    assert torch.allclose(values, expected.values, atol=1e-5)
+    assert torch.equal(indices, expected.indices)
+
+    # more candidates than a shard holds falls back to the full logits
+    values, indices = head.forward_topk(input, block_size + 1)
+    assert torch.equal(indices, torch.topk(input @ weight.T, block_size + 1, dim=-1).indices)
+
+
+def test_head_forward_topk():
+    run_distributed(_check_head_topk)
+
+
+def _check_sequence_parallel(rank, process_group, filename):
+    torch.manual_seed(0)
+    weights = Weights(
+        {
+            "dense.weight": torch.randn(HIDDEN, HIDDEN),
+            "dense.bias": torch.randn(HIDDEN),
+            "up.weight": torch.randn(2 * HIDDEN, HIDDEN),
+            "up.bias": torch.randn(2 * HIDDEN),
+            "embed.weight": torch.randn(VOCAB, HIDDEN),
+        },
+        process_group,
+        filename,
+    )
+    # odd number of tokens exercises the padding of the token dimension
+    input = torch.randn(5, HIDDEN)
+    input_ids = torch.randint(0, VOCAB, (5,))
+    block_size = HIDDEN // WORLD_SIZE
+    local_input = input[:, rank * block_size : (rank + 1) * block_size]
+    residual = torch.randn(6, HIDDEN)[rank * 3 : (rank + 1) * 3]
+    ln = torch.nn.LayerNorm(HIDDEN)
+
+    row = TensorParallelRowLinear.load(Config(), "dense", weights, bias=True)
+    up = TensorParallelColumnLinear.load(Config(), "up", weights, bias=True)
+    embedding = TensorParallelEmbedding("embed", weights)
+    row_sp = TensorParallelRowLinear.load(
+        Config(), "dense", weights, bias=True, sequence_parallel=True
+    )
+    up_sp = TensorParallelColumnLinear.load(
+        Config(), "up", weights, bias=True, sequence_parallel=True
+    )
+    embedding_sp = TensorParallelEmbedding("embed", weights, sequence_parallel=True)
+
+    expected_row = row(local_input)
+    full_residual = all_gather_tokens(residual, process_group, 5)
+    expected_up = up(ln(expected_row + full_residual))
+    expected_embedding = embedding(input_ids)
+
+    # without reduce-scatter support every rank all-reduces, gloo has it on recent torch
+    for backends in ({"nccl"}, {"nccl", "gloo"}):
+        layers.REDUCE_SCATTER_BACKENDS = backends
+        sharded = row_sp(local_input)
+        assert sharded.shape == (3, HIDDEN)
+        assert torch.allclose(all_gather_tokens(sharded, process_group, 5), expected_row, atol=1e-5)
+
+        # row -> residual and layer norm on this rank's tokens -> column gathers the tokens back
+        assert torch.allclose(up_sp(ln(sharded + residual), num_tokens=5), expected_up, atol=1e-5)
+
+        sharded = embedding_sp(input_ids)
+        assert torch.equal(all_gather_tokens(sharded, process_group, 5), expected_embedding)
+
+
+def test_sequence_parallel():
+    run_distributed(_check_sequence_parallel)
+
+
+def _check_int8_quantize(rank, process_group, filename):
+    torch.manual_seed(0)
+    weights = Weights(
+        {
+            "q.weight": torch.randn(HIDDEN, HIDDEN),
+            "q.bias": torch.randn(HIDDEN),
+            "k.weight": torch.randn(HIDDEN, HIDDEN),
+            "k.bias": torch.randn(HIDDEN),
+            "dense.weight": torch.randn(HIDDEN, HIDDEN),
+            "dense.bias": torch.randn(HIDDEN),
+        },
+        process_group,
+        filename,
+    )
+    input = torch.randn(2, 3, HIDDEN)
+
+    for quantize_config in (Config(), Config(quantize="int8")):
+        column = TensorParallelColumnLinear.load_multi(
+            quantize_config, ["q", "k"], weights, bias=True, dim=0
+        )
+        row = TensorParallelRowLinear.load(quantize_config, "dense", weights, bias=True)
+        if quantize_config.quantize is None:
+            expected = row(column(input)[..., : HIDDEN // WORLD_SIZE])
+        else:
+            assert isinstance(column.linear, Int8WeightOnlyLinear)
+            assert column.linear.weight.dtype == torch.int8
+            out = row(column(input)[..., : HIDDEN // WORLD_SIZE])
+            assert out.shape == expected.shape
+            assert torch.allclose(out, expected, rtol=0.05, atol=0.2)
+
+
+def _check_int8_quantize_dequantize(rank, process_group, filename):
+    # torch without the native int8 matmul (e.g. torch 2.0 in TGI 0.9.2) dequantizes on the fly
+    layers.HAS_INT8_PACK_MM = False
+    _check_int8_quantize(rank, process_group, filename)
+
+
+def test_int8_quantize():
+    run_distributed(_check_int8_quantize)
+
+
+def test_int8_quantize_dequantize():
+    run_distributed(_check_int8_quantize_dequantize)
+
+
+def test_int8_pack_mm_failure_falls_back(monkeypatch):
+    def unsupported(*args, **kwargs):
+        raise RuntimeError("unsupported dtype")
+
+    monkeypatch.setattr(torch, "_weight_int8pack_mm", unsupported, raising=False)
+    monkeypatch.setattr(layers, "HAS_INT8_PACK_MM", True)
+    torch.manual_seed(0)
+    weight = torch.randn(HIDDEN, HIDDEN)
+    input = torch.randn(3, HIDDEN)
+    with torch.inference_mode():
+        out = Int8WeightOnlyLinear(weight, None)(input)
+    assert torch.allclose(out, input @ weight.T, rtol=0.05, atol=0.2)
+
+
+def _check_preallocated_load(rank, process_group, filename):
+    # a few rows per block exercises copying shards in blocks
+    layers.LOAD_BLOCK_BYTES = 3 * HIDDEN * 4
+    torch.manual_seed(0)
+    tensors = {
+        "q.weight": torch.randn(HIDDEN, HIDDEN),
+        "q.bias": torch.randn(HIDDEN),
+        "k.weight": torch.randn(HIDDEN, HIDDEN),
+        "k.bias": torch.randn(HIDDEN),
+        "embed.weight": torch.randn(VOCAB, HIDDEN),
+    }
+    weights = Weights(tensors, process_group, filename)
+
+    column = TensorParallelColumnLinear.load_multi(
+        Config(), ["q", "k"], weights, bias=True, dim=0
+    )
+    block_size = HIDDEN // WORLD_SIZE
+    expected = torch.cat(
+        [
+            tensors[f"{p}.bias"][rank * block_size : (rank + 1) * block_size]
+            for p in ("q", "k")
+        ]
+    )
+    assert torch.equal(column.linear.bias, expected)
+    assert torch.equal(
+        column.linear.weight,
+        weights.get_multi_weights_col(["q", "k"], quantize=None, dim=0),
+    )
+
+    column = TensorParallelColumnLinear.load_multi(
+        Config(), ["q", "k"], weights, bias=False, dim=0
+    )
+    assert column.linear.bias is None
+    assert column.linear.weight.shape == (2 * block_size, HIDDEN)
+
+    embedding = TensorParallelEmbedding("embed", weights)
+    block_size = VOCAB // WORLD_SIZE
+    assert embedding.weight.shape == (block_size + 1, HIDDEN)
+    assert torch.equal(
+        embedding.weight[:block_size],
+        tensors["embed.weight"][rank * block_size : (rank + 1) * block_size],
+    )
+    assert not embedding.weight[block_size].any()
+
+    block_size = HIDDEN // WORLD_SIZE
+    out = layers.get_sharded_into(weights, "embed.weight", torch.empty(VOCAB, block_size), dim=1)
+    assert torch.equal(out, tensors["embed.weight"][:, rank * block_size : (rank + 1) * block_size])
+
+
+def test_preallocated_load():
+    run_distributed(_check_preallocated_load)
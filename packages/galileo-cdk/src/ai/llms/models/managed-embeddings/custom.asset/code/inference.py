@@ -1,10 +1,21 @@
+from startup_profile import StartupProfiler
+
+# created before the heavy imports so their time is part of the startup profile
+startup_profiler = StartupProfiler("managed-embeddings")
+
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional
 import torch
 import logging
 import torch.nn.functional as F
 from transformers import AutoModel, AutoModelForSequenceClassification, AutoTokenizer
 
+startup_profiler.mark("import")
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -27,9 +38,39 @@ logger.setLevel(logging.INFO)
 TYPE_EMBEDDING = "embedding"
 TYPE_CROSS_ENCODER = "cross-encoder"
 
-model_ids = os.environ["MANAGED_EMBEDDINGS_MODEL_IDS"]
-models_list = list(map(lambda val: val.strip(), model_ids.split(",")))
-models_num = len(models_list)
+E5_MODEL_PREFIX = "intfloat/multilingual-e5"
+E5_QUERY_PREFIX = "query: "
+
+# number of distinct input strings whose token ids are cached per model
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 4096))
+# inputs per forward pass, larger requests are pipelined in batches of this size which also bounds their peak memory
+EMBEDDINGS_BATCH_SIZE = int(os.environ.get("EMBEDDINGS_BATCH_SIZE", 64))
+tokenize_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenize")
+serialize_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="serialize")
+
+# forward pass precision of embedding models: (dtype weights are cast to at load, autocast dtype)
+PRECISION_FP32 = "fp32"
+PRECISIONS = {
+    PRECISION_FP32: (None, None),
+    "fp16": (torch.float16, None),
+    "bf16": (torch.bfloat16, None),
+    "autocast-fp16": (None, torch.float16),
+    "autocast-bf16": (None, torch.bfloat16),
+}
+# dtypes embeddings can be rounded to in the response, requested with "output_dtype"
+OUTPUT_DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+DEFAULT_OUTPUT_DTYPE = os.environ.get("MANAGED_EMBEDDINGS_OUTPUT_DTYPE", "fp32")
+
+with startup_profiler.phase("parse_model_ids"):
+    model_ids = os.environ["MANAGED_EMBEDDINGS_MODEL_IDS"]
+    models_list = list(map(lambda val: val.strip(), model_ids.split(",")))
+    models_num = len(models_list)
+    # one precision for all models, e.g. "autocast-fp16", and/or per model "<model_id>=<precision>,..." overriding it
+    model_precisions = os.environ.get("MANAGED_EMBEDDINGS_PRECISION", "")
 
 def process_model_list(model_list):
     return list(map(lambda x: x.split("/")[-1], model_list))
@@ -38,7 +79,8 @@ def process_model_list(model_list):
 def mean_pooling(model_output, attention_mask):
     """Mean Pooling - Take attention mask into account for correct averaging"""
     # First element of model_output contains all token embeddings
-    token_embeddings = model_output[0]
+    # accumulate in fp32 whatever precision the model ran in
+    token_embeddings = model_output[0].float()
     input_mask_expanded = (
         attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
     )
@@ -46,6 +88,124 @@ def mean_pooling(model_output, attention_mask):
         input_mask_expanded.sum(1), min=1e-9
     )
 
+class TokenizerStage:
+    """
+    Tokenizes inputs with the tokenizer's batch API into python lists, only padding and converting
+    to tensors once per batch, and keeps the token ids of recently seen strings in an LRU cache.
+    """
+
+    def __init__(self, tokenizer, prefix: str = "", cache_size: int = TOKEN_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, texts: List[str]) -> List[dict]:
+        """Token ids (and other tokenizer features) of every text, unpadded"""
+        with self._lock:
+            features = {text: self._cache[text] for text in texts if text in self._cache}
+            for text in features:
+                self._cache.move_to_end(text)
+
+        misses = [text for text in dict.fromkeys(texts) if text not in features]
+        if misses:
+            encoded = self.tokenizer(
+                [self.prefix + text for text in misses] if self.prefix else misses,
+                padding=False,
+                truncation=True,
+            )
+            with self._lock:
+                for i, text in enumerate(misses):
+                    features[text] = {key: values[i] for key, values in encoded.items()}
+                    if self.cache_size > 0:
+                        self._cache[text] = features[text]
+                        if len(self._cache) > self.cache_size:
+                            self._cache.popitem(last=False)
+
+        return [features[text] for text in texts]
+
+    def __call__(self, texts: List[str]):
+        return self.tokenizer.pad(self.encode(texts), padding=True, return_tensors="pt")
+
+
+def get_precision(model_id: str, precisions: str) -> str:
+    # a `<model_id>=<precision>` entry wins over a bare default wherever it appears
+    default_precision, model_precision = PRECISION_FP32, None
+    for entry in filter(None, map(lambda val: val.strip(), precisions.split(","))):
+        if "=" in entry:
+            entry_model_id, entry_precision = map(lambda val: val.strip(), entry.rsplit("=", 1))
+            if entry_model_id == model_id:
+                model_precision = entry_precision
+        else:
+            default_precision = entry
+    precision = model_precision or default_precision
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precision {precision} of {model_id} not supported: available precisions {list(PRECISIONS)}")
+    return precision
+
+
+def check_precision_supported(model_id: str, precision: str, device) -> None:
+    # bf16 needs an Ampere or newer GPU, e.g. not the T4 of ml.g4dn instances
+    if torch.bfloat16 in PRECISIONS[precision] and device.type == "cuda" and not torch.cuda.is_bf16_supported():
+        raise ValueError(f"Precision {precision} of {model_id} not supported: {torch.cuda.get_device_name(device)} has no bf16 support")
+
+
+def serialize_embeddings(embeddings: torch.Tensor, output_dtype: torch.dtype = torch.float32) -> list:
+    # numpy has no bf16, values are rounded to output_dtype and serialized as fp32
+    return embeddings.to(output_dtype).cpu().float().numpy().tolist()
+
+
+def embed(
+    model,
+    tokenize: TokenizerStage,
+    inputs: List[str],
+    device,
+    autocast_dtype: Optional[torch.dtype] = None,
+    output_dtype: torch.dtype = torch.float32,
+) -> list:
+    """
+    Normalized mean pooled embeddings of inputs, computed in batches of `EMBEDDINGS_BATCH_SIZE`.
+    The forward pass runs under autocast when `autocast_dtype` is given, pooling and normalization in fp32.
+
+    Batches flow through a pipeline: while batch N runs the forward pass, batch N+1 is tokenized
+    and copied to the device and batch N-1 is copied back and serialized, each on its own thread.
+    """
+    batches = [
+        inputs[i : i + EMBEDDINGS_BATCH_SIZE]
+        for i in range(0, len(inputs), EMBEDDINGS_BATCH_SIZE)
+    ]
+    pipelined = len(batches) > 1
+
+    def prepare(batch):
+        return tokenize(batch).to(device)
+
+    ret_value = []
+    serialized = None
+    next_encoded = tokenize_executor.submit(prepare, batches[0]) if pipelined else None
+    for i, batch in enumerate(batches):
+        encoded_input = next_encoded.result() if pipelined else prepare(batch)
+        if i + 1 < len(batches):
+            next_encoded = tokenize_executor.submit(prepare, batches[i + 1])
+
+        with torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            model_output = model(**encoded_input)
+        input_embeddings = mean_pooling(model_output, encoded_input["attention_mask"])
+        input_embeddings = F.normalize(input_embeddings, p=2, dim=1)
+        del model_output, encoded_input
+
+        if not pipelined:
+            return serialize_embeddings(input_embeddings, output_dtype)
+        # wait for the previous batch so at most one batch is in each stage
+        if serialized is not None:
+            ret_value.extend(serialized.result())
+        serialized = serialize_executor.submit(serialize_embeddings, input_embeddings, output_dtype)
+
+    if serialized is not None:
+        ret_value.extend(serialized.result())
+    return ret_value
+
+
 def get_model_type(model_id: str) -> str:
     if model_id.split("/")[0] == TYPE_CROSS_ENCODER:
         return TYPE_CROSS_ENCODER
@@ -54,21 +214,78 @@ def get_model_type(model_id: str) -> str:
 def is_cross_encoder(model_id: str) -> bool:
     return get_model_type(model_id) == TYPE_CROSS_ENCODER
 
+def load_embeddings_model(model_dir, model_id: str, device, precision: str) -> dict:
+    weights_dtype, autocast_dtype = PRECISIONS[precision]
+    embeddings_model_dir = f"{model_dir}/{model_id}"
+    with startup_profiler.phase("tokenizer", model_id):
+        embeddings_tokenizer = AutoTokenizer.from_pretrained(embeddings_model_dir)
+    with startup_profiler.phase("weights", model_id):
+        # casting at load never materializes the fp32 weights
+        embeddings_model = AutoModel.from_pretrained(embeddings_model_dir, torch_dtype=weights_dtype)
+    embeddings_model.eval()
+    with startup_profiler.phase("to_device", model_id):
+        embeddings_model.to(device)
+
+    return {
+        "model": embeddings_model,
+        "tokenizer": embeddings_tokenizer,
+        "tokenizer_stage": TokenizerStage(
+            embeddings_tokenizer,
+            prefix=E5_QUERY_PREFIX if model_id.startswith(E5_MODEL_PREFIX) else "",
+        ),
+        "precision": precision,
+        "autocast_dtype": autocast_dtype,
+    }
+
+
+def check_precision(model_dir, model_id: str, precision: str, inputs: List[str], atol: float = 1e-2) -> float:
+    """
+    Max absolute difference between the embeddings of inputs at precision and the fp32 reference,
+    raises a ValueError when above atol.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    embeddings: Dict[str, torch.Tensor] = {}
+    for current_precision in (PRECISION_FP32, precision):
+        model_config = load_embeddings_model(model_dir, model_id, device, current_precision)
+        with torch.inference_mode():
+            embeddings[current_precision] = torch.tensor(
+                embed(
+                    model_config["model"],
+                    model_config["tokenizer_stage"],
+                    inputs,
+                    device,
+                    autocast_dtype=model_config["autocast_dtype"],
+                )
+            )
+        del model_config
+
+    error = (embeddings[precision] - embeddings[PRECISION_FP32]).abs().max().item()
+    if error > atol:
+        raise ValueError(f"Embeddings of {model_id} at {precision} differ from fp32 by {error}, above {atol}")
+    return error
+
+
 def model_fn(model_dir):
     logger.info("model_fn")
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # fail at startup rather than on every request
+    if DEFAULT_OUTPUT_DTYPE not in OUTPUT_DTYPES:
+        raise ValueError(f"Output dtype {DEFAULT_OUTPUT_DTYPE} not supported: available dtypes {list(OUTPUT_DTYPES)}")
 
     config = {}
     for model_id in models_list:
         if is_cross_encoder(model_dir):
           cross_encoder_model_dir = os.path.join(model_dir, model_id)
-          cross_encoder_model = AutoModelForSequenceClassification.from_pretrained(
-              cross_encoder_model_dir
-          )
-          cross_encoder_tokenizer = AutoTokenizer.from_pretrained(cross_encoder_model_dir)
+          with startup_profiler.phase("weights", model_id):
+              cross_encoder_model = AutoModelForSequenceClassification.from_pretrained(
+                  cross_encoder_model_dir
+              )
+          with startup_profiler.phase("tokenizer", model_id):
+              cross_encoder_tokenizer = AutoTokenizer.from_pretrained(cross_encoder_model_dir)
 
           cross_encoder_model.eval()
-          cross_encoder_model.to(device)
+          with startup_profiler.phase("to_device", model_id):
+              cross_encoder_model.to(device)
 
           model_config = {
               "model": cross_encoder_model,
@@ -77,19 +294,11 @@ def model_fn(model_dir):
 
           config[model_id] = model_config
         else:
-          embeddings_model_dir = f"{model_dir}/{model_id}"
-          embeddings_tokenizer = AutoTokenizer.from_pretrained(embeddings_model_dir)
-          embeddings_model = AutoModel.from_pretrained(embeddings_model_dir)
-          embeddings_model.eval()
-          embeddings_model.to(device)
-
-          model_config = {
-              "model": embeddings_model,
-              "tokenizer": embeddings_tokenizer,
-          }
-
-          config[model_id] = model_config
+          precision = get_precision(model_id, model_precisions)
+          check_precision_supported(model_id, precision, device)
+          config[model_id] = load_embeddings_model(model_dir, model_id, device, precision)
 
+    startup_profiler.finish()
     return config
 
 
@@ -108,31 +317,26 @@ def predict_fn(input_object, config):
 
     if current_is_cross_encoder != True:
         current_input = input_object["input"]
-        if current_model_id.startswith("intfloat/multilingual-e5"):
-            if isinstance(current_input, list):
-                current_input = list(map(lambda val: "query: " + val, current_input))
-            else:
-                current_input = "query: " + current_input
+        if not isinstance(current_input, list):
+            current_input = [current_input]
 
-        with torch.inference_mode():
-            encoded_input = current_tokenizer(
-                current_input,
-                padding=True,
-                truncation=True,
-                return_tensors="pt",
-            )
+        if not current_input:
+            return []
 
-            encoded_input = encoded_input.to(device)
-            model_output = current_model(**encoded_input)
+        output_dtype = input_object.get("output_dtype", DEFAULT_OUTPUT_DTYPE)
+        if output_dtype not in OUTPUT_DTYPES:
+            raise ValueError(f"Output dtype {output_dtype} not supported: available dtypes {list(OUTPUT_DTYPES)}")
 
-            input_embeddings = mean_pooling(
-                model_output, encoded_input["attention_mask"]
+        with torch.inference_mode():
+            ret_value = embed(
+                current_model,
+                current_model_config["tokenizer_stage"],
+                current_input,
+                device,
+                autocast_dtype=current_model_config["autocast_dtype"],
+                output_dtype=OUTPUT_DTYPES[output_dtype],
             )
 
-            input_embeddings = F.normalize(input_embeddings, p=2, dim=1)
-            response = input_embeddings.cpu().numpy()
-            ret_value = response.tolist()
-
             return ret_value
     else:
         current_input = input_object["input"]
@@ -0,0 +1,141 @@
+"""
+Opt-in startup profiler for the inference handlers, enabled with `STARTUP_PROFILE=true`.
+
+Records the duration and memory of each startup phase (imports, tokenizer and weight loading,
+moving to device, ...) per model and logs a JSON report at the end of `model_fn`, also written
+to `STARTUP_PROFILE_PATH` when set. Kept free of torch imports so it can time importing torch.
+
+The report can be checked against per phase time budgets, e.g. in CI with small test models:
+    python startup_profile.py report.json --budgets budgets.json
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _rss_mb() -> Optional[float]:
+    """Current resident set size, linux only"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return None
+
+
+def _process_uptime() -> Optional[float]:
+    """Seconds since the process started, covers the container boot before the handler is imported, linux only"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfiler:
+    def __init__(self, handler: str, enabled: Optional[bool] = None):
+        if enabled is None:
+            enabled = os.environ.get("STARTUP_PROFILE", "false").lower() == "true"
+        self.handler = handler
+        self.enabled = enabled
+        self.phases = []
+        self.report: Optional[dict] = None
+        self._start = self._last_mark = time.perf_counter()
+
+    def _record(self, phase: str, model: Optional[str], seconds: float, rss_before: Optional[float]):
+        rss = _rss_mb()
+        entry = {
+            "phase": phase,
+            "model": model,
+            "seconds": round(seconds, 4),
+            "rss_mb": rss,
+            "rss_delta_mb": rss - rss_before if rss is not None and rss_before is not None else None,
+            # ru_maxrss is reported in KB on linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            entry["cuda_allocated_mb"] = torch.cuda.memory_allocated() / 1024 ** 2
+            entry["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 1024 ** 2
+        self.phases.append(entry)
+
+    def mark(self, phase: str, model: Optional[str] = None):
+        """Record the time since the previous mark (or profiler creation) as phase, e.g. for module imports"""
+        now = time.perf_counter()
+        if self.enabled:
+            self._record(phase, model, now - self._last_mark, None)
+        self._last_mark = now
+
+    @contextmanager
+    def phase(self, phase: str, model: Optional[str] = None):
+        if not self.enabled:
+            yield
+            return
+        rss_before = _rss_mb()
+        start = time.perf_counter()
+        yield
+        self._record(phase, model, time.perf_counter() - start, rss_before)
+        self._last_mark = time.perf_counter()
+
+    def finish(self) -> Optional[dict]:
+        """Log and return the report, call at the end of model_fn"""
+        if not self.enabled:
+            return None
+        self.report = {
+            "handler": self.handler,
+            "total_seconds": round(time.perf_counter() - self._start, 4),
+            "process_uptime_seconds": _process_uptime(),
+            "phases": self.phases,
+        }
+        logger.info(f"Startup profile: {json.dumps(self.report)}")
+        path = os.environ.get("STARTUP_PROFILE_PATH")
+        if path:
+            with open(path, "w") as f:
+                json.dump(self.report, f, indent=2)
+        return self.report
+
+
+def check_report(report: dict, budgets: Dict[str, float]) -> list:
+    """
+    Phases exceeding their budget in seconds, budgets are keyed by phase name (summed over models)
+    or `total` for the whole of the handler startup.
+    """
+    totals: Dict[str, float] = {"total": report["total_seconds"]}
+    for entry in report["phases"]:
+        totals[entry["phase"]] = totals.get(entry["phase"], 0.0) + entry["seconds"]
+    return [
+        f"{phase}: {totals[phase]:.3f}s exceeds budget of {budget:.3f}s"
+        for phase, budget in budgets.items()
+        if totals.get(phase, 0.0) > budget
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("report", help="report written to STARTUP_PROFILE_PATH")
+    parser.add_argument("--budgets", required=True, help='JSON of phase -> max seconds, e.g. {"weights": 5, "total": 20}')
+    args = parser.parse_args()
+
+    with open(args.report) as f:
+        report = json.load(f)
+    with open(args.budgets) as f:
+        budgets = json.load(f)
+    failures = check_report(report, budgets)
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
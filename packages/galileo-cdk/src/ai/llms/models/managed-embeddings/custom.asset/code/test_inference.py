@@ -0,0 +1,128 @@
+import os
+
+import pytest
+import torch
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+MODEL_ID = "intfloat/multilingual-e5-tiny"
+os.environ["MANAGED_EMBEDDINGS_MODEL_IDS"] = MODEL_ID
+os.environ["STARTUP_PROFILE"] = "true"
+
+import inference
+from startup_profile import check_report
+
+WORDS = ["query", ":", "i", "love", "berlin", "paris", "london", "and"]
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """Tiny randomly initialized BERT saved the way model.tar.gz lays out multiple models"""
+    model_dir = tmp_path_factory.mktemp("model")
+    save_dir = model_dir / MODEL_ID
+    save_dir.mkdir(parents=True)
+    vocab_file = save_dir / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *WORDS]) + "\n")
+    BertTokenizerFast(vocab_file=str(vocab_file)).save_pretrained(save_dir)
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(WORDS) + 5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    BertModel(config).save_pretrained(save_dir)
+    return str(model_dir)
+
+
+@pytest.fixture(scope="module")
+def config(model_dir):
+    return inference.model_fn(model_dir)
+
+
+def reference_embeddings(config, inputs):
+    """Embeddings as computed before tokenization was batched and cached"""
+    model_config = config[MODEL_ID]
+    with torch.inference_mode():
+        encoded = model_config["tokenizer"](["query: " + text for text in inputs], padding=True, truncation=True, return_tensors="pt")
+        output = model_config["model"](**encoded)
+        return torch.nn.functional.normalize(inference.mean_pooling(output, encoded["attention_mask"]), p=2, dim=1)
+
+
+def test_tokenizer_stage_cache(config):
+    stage = inference.TokenizerStage(config[MODEL_ID]["tokenizer"], prefix="query: ", cache_size=2)
+    features = stage.encode(["i love berlin", "i love paris", "i love berlin"])
+    assert features[0] == features[2]
+    assert features[0]["input_ids"] == config[MODEL_ID]["tokenizer"]("query: i love berlin")["input_ids"]
+    assert list(stage._cache) == ["i love berlin", "i love paris"]
+
+    stage.encode(["i love london"])
+    assert list(stage._cache) == ["i love paris", "i love london"]
+
+
+def test_predict_fn_string(config):
+    embeddings = inference.predict_fn({"input": "i love berlin"}, config)
+    assert torch.allclose(torch.tensor(embeddings), reference_embeddings(config, ["i love berlin"]), atol=1e-5)
+
+
+def test_predict_fn_batches(config, monkeypatch):
+    monkeypatch.setattr(inference, "EMBEDDINGS_BATCH_SIZE", 2)
+    inputs = ["i love berlin", "paris", "i love london and paris", "berlin", "i love berlin"]
+    embeddings = inference.predict_fn({"input": inputs}, config)
+    assert len(embeddings) == len(inputs)
+    assert torch.allclose(torch.tensor(embeddings), reference_embeddings(config, inputs), atol=1e-5)
+
+
+def test_startup_profile(config):
+    report = inference.startup_profiler.report
+    assert report["handler"] == "managed-embeddings"
+    phases = [(entry["phase"], entry["model"]) for entry in report["phases"]]
+    assert phases == [
+        ("import", None),
+        ("parse_model_ids", None),
+        ("tokenizer", MODEL_ID),
+        ("weights", MODEL_ID),
+        ("to_device", MODEL_ID),
+    ]
+    assert all(entry["seconds"] >= 0 for entry in report["phases"])
+
+    assert check_report(report, {"weights": 60, "total": 120}) == []
+    assert check_report(report, {"weights": 0}) == [
+        f"weights: {report['phases'][3]['seconds']:.3f}s exceeds budget of 0.000s"
+    ]
+
+
+def test_get_precision():
+    assert inference.get_precision(MODEL_ID, "") == "fp32"
+    assert inference.get_precision(MODEL_ID, "autocast-bf16") == "autocast-bf16"
+    assert inference.get_precision(MODEL_ID, f"other/model=fp16, {MODEL_ID}=bf16") == "bf16"
+    assert inference.get_precision(MODEL_ID, "other/model=fp16") == "fp32"
+    assert inference.get_precision(MODEL_ID, f"{MODEL_ID}=bf16,autocast-fp16") == "bf16"
+    assert inference.get_precision("other/model", f"{MODEL_ID}=bf16,autocast-fp16") == "autocast-fp16"
+    with pytest.raises(ValueError):
+        inference.get_precision(MODEL_ID, "int4")
+
+
+def test_model_fn_validates_settings(model_dir, monkeypatch):
+    monkeypatch.setattr(inference, "DEFAULT_OUTPUT_DTYPE", "int8")
+    with pytest.raises(ValueError, match="Output dtype int8"):
+        inference.model_fn(model_dir)
+    monkeypatch.undo()
+
+    # e.g. a T4 GPU, rejected before any weights are loaded
+    monkeypatch.setattr(inference, "model_precisions", "autocast-bf16")
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    monkeypatch.setattr(torch.cuda, "is_bf16_supported", lambda *args, **kwargs: False)
+    monkeypatch.setattr(torch.cuda, "get_device_name", lambda *args, **kwargs: "Tesla T4")
+    with pytest.raises(ValueError, match="Tesla T4 has no bf16 support"):
+        inference.model_fn(model_dir)
+
+
+@pytest.mark.parametrize("precision", ["bf16", "autocast-bf16"])
+def test_check_precision(model_dir, precision):
+    inputs = ["i love berlin", "paris", "i love london and paris"]
+    assert inference.check_precision(model_dir, MODEL_ID, precision, inputs, atol=0.05) > 0
+    with pytest.raises(ValueError):
+        inference.check_precision(model_dir, MODEL_ID, precision, inputs, atol=0)
+
+
+def test_predict_fn_output_dtype(config):
+    embeddings = torch.tensor(inference.predict_fn({"input": "i love berlin", "output_dtype": "bf16"}, config))
+    assert torch.equal(embeddings, embeddings.bfloat16().float())
+    assert torch.allclose(embeddings, reference_embeddings(config, ["i love berlin"]), atol=1e-2)
+    with pytest.raises(ValueError):
+        inference.predict_fn({"input": "i love berlin", "output_dtype": "int8"}, config)
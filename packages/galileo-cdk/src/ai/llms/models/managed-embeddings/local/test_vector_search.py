@@ -0,0 +1,43 @@
+import numpy as np
+
+from vector_search import VectorIndex, benchmark, recall_at_k
+
+
+def write_corpus(tmp_path, num_rows=2000, dims=32, dtype=np.float32):
+    rng = np.random.default_rng(0)
+    # clustered corpus so the IVF partitions are meaningful
+    centers = rng.normal(size=(20, dims))
+    embeddings = (centers[rng.integers(0, 20, num_rows)] + 0.3 * rng.normal(size=(num_rows, dims))).astype(dtype)
+    np.save(tmp_path / "embeddings.npy", embeddings)
+    (tmp_path / "ids.txt").write_text("\n".join(f"chunk-{i}" for i in range(num_rows)) + "\n")
+    return embeddings
+
+
+def test_exact_search_matches_brute_force(tmp_path):
+    embeddings = write_corpus(tmp_path, dtype=np.float16)
+    index = VectorIndex.load(str(tmp_path / "embeddings.npy"), str(tmp_path / "ids.txt"), block_size=300)
+    assert isinstance(index.embeddings, np.memmap)
+
+    queries = np.random.default_rng(1).normal(size=(5, 32))
+    scores, ids = index.search(queries, 10)
+
+    corpus = embeddings.astype(np.float32)
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    expected = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ corpus.T
+    expected_rows = np.argsort(-expected, axis=1)[:, :10]
+    assert ids.tolist() == [[f"chunk-{row}" for row in rows] for rows in expected_rows]
+    assert np.allclose(scores, np.take_along_axis(expected, expected_rows, axis=1), atol=1e-5)
+
+
+def test_ivf_recall(tmp_path):
+    embeddings = write_corpus(tmp_path)
+    index = VectorIndex.load(str(tmp_path / "embeddings.npy"), str(tmp_path / "ids.txt"))
+    queries = embeddings[:50]
+
+    _, exact = index.search_indices(queries, 10)
+    ivf = index.build_ivf(16)
+    _, probe_all = ivf.search_indices(queries, 10, n_probe=16)
+    assert recall_at_k(probe_all, exact) == 1.0
+
+    report = benchmark(index, queries, 10, n_lists=16, n_probe=4)
+    assert report["ivf_recall"] > 0.8
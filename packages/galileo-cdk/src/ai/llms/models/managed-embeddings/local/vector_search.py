@@ -0,0 +1,224 @@
+"""
+In-process stand-in for the pgvector store, to benchmark retrieval latency and recall without any service.
+
+Embeddings are a float32/float16 `.npy` matrix (one row per chunk, memory-mapped) with a
+text file of ids (one per line, in row order), answering top-k cosine similarity queries
+with exact brute-force search or an IVF style partitioned index.
+
+Usage:
+    python vector_search.py --embeddings embeddings.npy --ids ids.txt --k 10 --n-lists 256 --n-probe 8
+"""
+import argparse
+import json
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+BLOCK_SIZE = 65536  # corpus rows scored at once, bounds memory while scanning the memory-mapped matrix
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.clip(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12, None)
+
+
+def merge_top_k(
+    scores: np.ndarray, indices: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k best scores (and matching indices) of every row, sorted by descending score"""
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        indices = np.take_along_axis(indices, top, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+class VectorIndex:
+    """Exact cosine similarity search over a (memory-mapped) embedding matrix"""
+
+    def __init__(self, embeddings: np.ndarray, ids: List[str], block_size: int = BLOCK_SIZE):
+        if len(ids) != embeddings.shape[0]:
+            raise ValueError(f"Got {len(ids)} ids for {embeddings.shape[0]} embeddings")
+        self.embeddings = embeddings
+        self.ids = np.asarray(ids)
+        self.block_size = block_size
+        self._inv_norms: Optional[np.ndarray] = None
+
+    @classmethod
+    def load(cls, embeddings_path: str, ids_path: str, **kwargs) -> "VectorIndex":
+        embeddings = np.load(embeddings_path, mmap_mode="r")
+        with open(ids_path) as f:
+            ids = [line.rstrip("\n") for line in f]
+        return cls(embeddings, ids, **kwargs)
+
+    @property
+    def inv_norms(self) -> np.ndarray:
+        """Inverse L2 norm of every row, computed once in blocks"""
+        if self._inv_norms is None:
+            inv_norms = np.empty(self.embeddings.shape[0], dtype=np.float32)
+            for start in range(0, self.embeddings.shape[0], self.block_size):
+                block = np.asarray(self.embeddings[start : start + self.block_size], dtype=np.float32)
+                inv_norms[start : start + len(block)] = 1.0 / np.clip(np.linalg.norm(block, axis=1), 1e-12, None)
+            self._inv_norms = inv_norms
+        return self._inv_norms
+
+    def score_rows(self, queries: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Cosine similarity of normalized queries against the given corpus rows"""
+        block = np.asarray(self.embeddings[rows], dtype=np.float32)
+        return (queries @ block.T) * self.inv_norms[rows]
+
+    def search_indices(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top-k, returns (scores, row indices) of shape (num queries, k)"""
+        queries = normalize(np.atleast_2d(queries))
+        k = min(k, self.embeddings.shape[0])
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.embeddings.shape[0], self.block_size):
+            block = np.asarray(self.embeddings[start : start + self.block_size], dtype=np.float32)
+            scores = (queries @ block.T) * self.inv_norms[start : start + len(block)]
+            indices = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            best_scores, best_indices = merge_top_k(
+                np.concatenate([best_scores, scores], axis=1),
+                np.concatenate([best_indices, indices], axis=1),
+                k,
+            )
+        return best_scores, best_indices
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top-k, returns (scores, ids) of shape (num queries, k)"""
+        scores, indices = self.search_indices(queries, k)
+        return scores, self.ids[indices]
+
+    def build_ivf(self, n_lists: int, **kwargs) -> "IVFIndex":
+        return IVFIndex.build(self, n_lists, **kwargs)
+
+
+class IVFIndex:
+    """
+    Inverted file index, rows are partitioned by their closest k-means centroid and a query
+    only scores the rows of its `n_probe` closest partitions.
+    """
+
+    def __init__(self, index: VectorIndex, centroids: np.ndarray, assignments: np.ndarray):
+        self.index = index
+        self.centroids = centroids
+        # rows grouped by partition, partition i holds order[offsets[i]:offsets[i + 1]]
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))])
+
+    @classmethod
+    def build(
+        cls,
+        index: VectorIndex,
+        n_lists: int,
+        n_iter: int = 10,
+        sample_size: int = 100000,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Spherical k-means over a sample of the corpus, then assigns every row to its closest centroid"""
+        rng = np.random.default_rng(seed)
+        num_rows = index.embeddings.shape[0]
+        n_lists = min(n_lists, num_rows)
+        sample_rows = np.sort(rng.choice(num_rows, size=min(sample_size, num_rows), replace=False))
+        sample = normalize(index.embeddings[sample_rows])
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = sample[assignments == i]
+                if len(members):
+                    centroids[i] = members.sum(axis=0)
+            centroids = normalize(centroids)
+
+        assignments = np.empty(num_rows, dtype=np.int64)
+        for start in range(0, num_rows, index.block_size):
+            block = np.asarray(index.embeddings[start : start + index.block_size], dtype=np.float32)
+            assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return cls(index, centroids, assignments)
+
+    def search_indices(self, queries: np.ndarray, k: int, n_probe: int = 8) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top-k, returns (scores, row indices), padded with -inf / -1 when fewer than k rows are probed"""
+        queries = normalize(np.atleast_2d(queries))
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, query in enumerate(queries):
+            # sorted rows keep reads from the memory-mapped matrix sequential
+            rows = np.sort(np.concatenate([self.order[self.offsets[p] : self.offsets[p + 1]] for p in probes[q]]))
+            if not len(rows):
+                continue
+            scores, indices = merge_top_k(self.index.score_rows(query[None], rows), rows[None], k)
+            all_scores[q, : scores.shape[1]] = scores[0]
+            all_indices[q, : indices.shape[1]] = indices[0]
+        return all_scores, all_indices
+
+    def search(self, queries: np.ndarray, k: int, n_probe: int = 8) -> Tuple[np.ndarray, np.ndarray]:
+        scores, indices = self.search_indices(queries, k, n_probe)
+        ids = np.where(indices >= 0, self.index.ids[np.maximum(indices, 0)], None)
+        return scores, ids
+
+
+def recall_at_k(approx_indices: np.ndarray, exact_indices: np.ndarray) -> float:
+    """Fraction of the exact top-k results also returned by the approximate search"""
+    hits = sum(len(np.intersect1d(approx, exact)) for approx, exact in zip(approx_indices, exact_indices))
+    return hits / exact_indices.size
+
+
+def benchmark(
+    index: VectorIndex,
+    queries: np.ndarray,
+    k: int,
+    n_lists: Optional[int] = None,
+    n_probe: int = 8,
+) -> dict:
+    """Latency of exact search, and latency and recall of the IVF index when n_lists is given"""
+    report = {"rows": index.embeddings.shape[0], "dimensions": index.embeddings.shape[1], "queries": len(queries), "k": k}
+
+    # untimed warm up, computes the lazy row norms and faults in the memory-mapped pages
+    index.inv_norms
+    index.search_indices(queries[:1], k)
+
+    start = time.perf_counter()
+    _, exact = index.search_indices(queries, k)
+    report["exact_ms_per_query"] = (time.perf_counter() - start) * 1000 / len(queries)
+
+    if n_lists:
+        start = time.perf_counter()
+        ivf = index.build_ivf(n_lists)
+        report["ivf_build_seconds"] = time.perf_counter() - start
+        start = time.perf_counter()
+        _, approx = ivf.search_indices(queries, k, n_probe)
+        report["ivf_ms_per_query"] = (time.perf_counter() - start) * 1000 / len(queries)
+        report["ivf_n_lists"] = n_lists
+        report["ivf_n_probe"] = n_probe
+        report["ivf_recall"] = recall_at_k(approx, exact)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--embeddings", required=True, help="float32/float16 .npy embedding matrix")
+    parser.add_argument("--ids", required=True, help="text file with one id per embedding row")
+    parser.add_argument("--queries", help=".npy query matrix, defaults to sampling corpus rows")
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n-lists", type=int, help="build an IVF index with this many partitions")
+    parser.add_argument("--n-probe", type=int, default=8)
+    args = parser.parse_args()
+
+    index = VectorIndex.load(args.embeddings, args.ids)
+    if args.queries:
+        queries = np.load(args.queries)
+    else:
+        rows = np.random.default_rng(0).choice(index.embeddings.shape[0], size=args.num_queries, replace=False)
+        queries = np.asarray(index.embeddings[np.sort(rows)], dtype=np.float32)
+    print(json.dumps(benchmark(index, queries, args.k, args.n_lists, args.n_probe), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
+from startup_profile import StartupProfiler
+
+# created before the heavy imports so their time is part of the startup profile
+startup_profiler = StartupProfiler("sentence-transformer")
+
 from transformers import AutoTokenizer, AutoModel
 import torch
 import torch.nn.functional as F
 
+startup_profiler.mark("import")
+
 # Helper: Mean Pooling - Take attention mask into account for correct averaging
 def mean_pooling(model_output, attention_mask):
     token_embeddings = model_output[0] #First element of model_output contains all token embeddings
@@ -11,8 +18,11 @@ def mean_pooling(model_output, attention_mask):
 
 def model_fn(model_dir):
   # Load model from HuggingFace Hub
-  tokenizer = AutoTokenizer.from_pretrained(model_dir)
-  model = AutoModel.from_pretrained(model_dir)
+  with startup_profiler.phase("tokenizer"):
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+  with startup_profiler.phase("weights"):
+    model = AutoModel.from_pretrained(model_dir)
+  startup_profiler.finish()
   return model, tokenizer
 
 def predict_fn(data, model_and_tokenizer):
@@ -0,0 +1,45 @@
+# code/ is a package named like the stdlib `code` module, run from this directory with:
+#   python -m pytest --import-mode=importlib test_inference.py
+import os
+
+import pytest
+import torch
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+os.environ["STARTUP_PROFILE"] = "true"
+
+import inference
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+WORDS = ["i", "love", "berlin", "paris"]
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """Tiny randomly initialized BERT saved the way model.tar.gz lays it out"""
+    model_dir = tmp_path_factory.mktemp("model")
+    vocab_file = model_dir / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *WORDS]) + "\n")
+    BertTokenizerFast(vocab_file=str(vocab_file)).save_pretrained(model_dir)
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(WORDS) + 5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    BertModel(config).save_pretrained(model_dir)
+    return str(model_dir)
+
+
+def test_startup_profile(model_dir):
+    model_and_tokenizer = inference.model_fn(model_dir)
+    report = inference.startup_profiler.report
+    assert report["handler"] == "sentence-transformer"
+    assert [entry["phase"] for entry in report["phases"]] == ["import", "tokenizer", "weights"]
+
+    embeddings = inference.predict_fn({"inputs": "i love berlin"}, model_and_tokenizer)
+    assert len(embeddings["vectors"]) == 32
+
+
+def test_startup_profile_in_sync():
+    """startup_profile.py is copied into each handler's code/ directory, the copies must not drift"""
+    with open(os.path.join(DIR, "startup_profile.py")) as f, open(
+        os.path.join(DIR, "..", "..", "..", "managed-embeddings", "custom.asset", "code", "startup_profile.py")
+    ) as original:
+        assert f.read() == original.read()